@@ -12,83 +12,269 @@ Licensed under the Apache License 2.0, see the file LICENSE for more details.
 Brought to you by the NLP-Lab.org (https://nlp-lab.org/)!
 """
 
-from collections import OrderedDict, defaultdict
-from typing import List, Generator
-from flair.data import Sentence, Token
-from flair.embeddings import StackedEmbeddings, WordEmbeddings, FlairEmbeddings, CharacterEmbeddings, BytePairEmbeddings
-from flair.models import SequenceTagger, TextClassifier
-from flair.nn import Model
-from flair import __version__ as flair_version
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Generator, Iterable, Iterator, Tuple, TYPE_CHECKING
+import copy
+import difflib
+import inspect
+import json
+import os
 import pyjsonnlp
-import functools
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from pyjsonnlp.pipeline import Pipeline
 from pyjsonnlp.tokenization import segment
 
+from flairjsonnlp.cache import AnnotationCache
+from flairjsonnlp.chunking import Chunking
+from flairjsonnlp import metrics
+from flairjsonnlp.registry import EmbeddingRegistry, ModelRegistry
+from flairjsonnlp.vectors import EmbeddingFormat, token_vectors
+
+# flair and torch are imported where they are first needed, importing them takes seconds
+if TYPE_CHECKING:
+    from flair.data import Sentence
+    from flair.embeddings import StackedEmbeddings
+    from flair.models import SequenceTagger, TextClassifier
+    from flair.nn import Model
+    from flairjsonnlp.pool import InferencePool
+
 name = "flairjsonnlp"
 
 __version__ = "0.0.9"
-__cache = defaultdict(dict)
 
+# the annotation layers get_nlp_json can write
+LAYERS = frozenset(('upos', 'pos', 'ner', 'frame', 'expressions', 'sentiment', 'embeddings'))
+# layers that need the tags of other layers, the wordnet id of a frame contains the universal pos
+LAYER_DEPENDENCIES = {'frame': ('upos',)}
+# meta of a document that describes how a request produced it, never cached
+REQUEST_META = ('models', 'timing')
+# the order the models of the layers run in
+MODEL_ORDER = ('pos', 'ner', 'frame', 'expressions', 'sentiment', 'upos')
+model_registry = ModelRegistry(max_entries=16)
+embedding_registry = EmbeddingRegistry(max_entries=4)
+metrics.watch_registry('model', model_registry)
+metrics.watch_registry('embedding', embedding_registry)
 
-def cache_it(func):
-    """A decorator to cache function response based on params"""
 
-    global __cache
+# pre-extracted models, {model_dir}/{name}.pt, are loaded from here instead of Flair's download cache
+model_dir = os.environ.get('FLAIRJSONNLP_MODEL_DIR')
 
-    @functools.wraps(func)
-    def cached(*args):
-        f_name = func.__name__
-        s = ''.join(map(str, args))
-        if s not in __cache[f_name]:
-            __cache[f_name][s] = func(*args)
-        return __cache[f_name][s]
-    return cached
 
+def set_model_dir(path: str = None):
+    global model_dir
+    model_dir = path
 
-@cache_it
-def get_sequence_model(model_name) -> SequenceTagger:
-    return SequenceTagger.load(model_name)
 
+def get_flair_version() -> str:
+    from flair import __version__
+    return __version__
 
-@cache_it
-def get_classifier_model(model_name) -> TextClassifier:
-    return TextClassifier.load(model_name)
 
+# fp32, or int8 for the dynamically quantized CPU models of flairjsonnlp.quantize
+BACKENDS = ('fp32', 'int8')
+backend = os.environ.get('FLAIRJSONNLP_BACKEND', 'fp32')
 
-class FlairPipeline(Pipeline):
-    @staticmethod
-    def process(text='', lang='en', use_ontonotes=False, fast=True, use_embeddings='', char_embeddings=False, bpe_size: int = 0, coreferences=False, constituents=False, dependencies=False, expressions=False, pos=True, sentiment=True) -> OrderedDict:
-        if use_embeddings == 'default':
-            use_embeddings = 'glove,multi-forward,multi-backward'
-        embed_type = f'Flair {use_embeddings}' + (',char' if char_embeddings else '') + (f',byte-pair_{bpe_size}' if bpe_size > 0 else '')
 
-        if bpe_size not in (0, 50, 100, 200, 300):
-            raise ValueError(f'bpe_size must be one of 0, 50, 100, 200, 300. {bpe_size} is not allowed.')
+def set_backend(name: str = 'fp32'):
+    global backend
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown backend {name}, use {", ".join(BACKENDS)}.')
+    backend = name
 
-        sentences = FlairPipeline.get_sentences(text, lang, use_ontonotes, fast, use_embeddings, char_embeddings, bpe_size, expressions, pos, sentiment)
 
-        return FlairPipeline.get_nlp_json(sentences, text, embed_type)
+def model_key(kind: str, model_name: str) -> tuple:
+    """The model registry key of a model in the current backend"""
+    return (kind, model_name) if backend == 'fp32' else (kind, model_name, backend)
+
+
+def get_sequence_model(model_name) -> 'SequenceTagger':
+    from flair.models import SequenceTagger
+    return model_registry.get(model_key('sequence', model_name), lambda: load_backend_model(SequenceTagger, model_name))
+
+
+def get_classifier_model(model_name) -> 'TextClassifier':
+    from flair.models import TextClassifier
+    return model_registry.get(model_key('classifier', model_name), lambda: load_backend_model(TextClassifier, model_name))
+
+
+def load_backend_model(cls, model_name: str):
+    start = time.perf_counter()
+    if backend == 'int8':
+        from flairjsonnlp.quantize import load_quantized
+        model = load_quantized(cls, model_name)
+    else:
+        model = load_model(cls, model_name)
+    metrics.model_loads_total.inc(model=model_name, backend=backend)
+    metrics.model_load_seconds.observe(time.perf_counter() - start, backend=backend)
+    return model
+
+
+def load_model(cls, model_name: str):
+    """Load a model from model_dir if it is there, else through Flair"""
+    path = os.path.join(model_dir, f'{model_name}.pt') if model_dir else None
+    if path is None or not os.path.exists(path):
+        return cls.load(model_name)
+    return load_mapped(cls, path)
+
+
+def load_mapped(cls, path: str):
+    """Load a model file with its weights memory-mapped, so worker processes share the pages of the file.
+
+    Needs torch 2.1 or later and a file in the zip format of torch.save, anything else is loaded by Flair."""
+    import flair
+    import torch
+    try:
+        state = torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+    except (TypeError, RuntimeError):
+        return cls.load(path)
+    model = cls._init_model_with_state_dict(state)
+    # point the parameters at the mapped tensors instead of the copies made by the constructor
+    model.load_state_dict(state['state_dict'], assign=True)
+    model.eval()
+    model.to(flair.device)
+    return model
 
+
+class FlairPipeline(Pipeline):
     @staticmethod
-    def get_sentences(text, lang, use_ontonotes, fast, use_embeddings, char_embeddings, bpe_size, expressions, pos, sentiment) -> List[Sentence]:
-        """Process text using Flair and return the output from Flair"""
+    def process(text='', lang='en', use_ontonotes=False, fast=True, use_embeddings='', char_embeddings=False, bpe_size: int = 0, coreferences=False, constituents=False, dependencies=False, expressions=False, pos=True, sentiment=True, embedding_format: EmbeddingFormat = None, cache: AnnotationCache = None, pool: 'InferencePool' = None, fuse: bool = False, chunking: Chunking = None, layers: Iterable[str] = None, timing: bool = False) -> OrderedDict:
+        return next(FlairPipeline.process_iter([text], lang=lang, use_ontonotes=use_ontonotes, fast=fast, use_embeddings=use_embeddings,
+                                               char_embeddings=char_embeddings, bpe_size=bpe_size, expressions=expressions, pos=pos,
+                                               sentiment=sentiment, window=1, embedding_format=embedding_format, cache=cache, pool=pool, fuse=fuse,
+                                               chunking=chunking, layers=layers, timing=timing))
 
-        if lang not in ('en', 'multi', 'de', 'nl', 'fr'):
-            raise TypeError(
-                f'{lang} is not supported! Try multi. See https://github.com/zalandoresearch/flair/blob/master/resources/docs/TUTORIAL_2_TAGGING.md')
+    @staticmethod
+    def process_many(texts: Iterable[str], lang='en', use_ontonotes=False, fast=True, use_embeddings='', char_embeddings=False, bpe_size: int = 0, coreferences=False, constituents=False, dependencies=False, expressions=False, pos=True, sentiment=True, batch_size: int = 32, embedding_format: EmbeddingFormat = None, cache: AnnotationCache = None, pool: 'InferencePool' = None, fuse: bool = False, chunking: Chunking = None, layers: Iterable[str] = None, timing: bool = False) -> List[OrderedDict]:
+        """Process a corpus, running every model once over the pooled sentences of all texts.
 
-        # tokenize sentences
+        Returns one JSON-NLP document per text, in the order of the input."""
+        return list(FlairPipeline.process_iter(texts, lang=lang, use_ontonotes=use_ontonotes, fast=fast, use_embeddings=use_embeddings,
+                                               char_embeddings=char_embeddings, bpe_size=bpe_size, expressions=expressions, pos=pos,
+                                               sentiment=sentiment, batch_size=batch_size, window=0, embedding_format=embedding_format,
+                                               cache=cache, pool=pool, fuse=fuse, chunking=chunking, layers=layers, timing=timing))
+
+    @staticmethod
+    def process_iter(texts: Iterable[str], lang='en', use_ontonotes=False, fast=True, use_embeddings='', char_embeddings=False, bpe_size: int = 0, coreferences=False, constituents=False, dependencies=False, expressions=False, pos=True, sentiment=True, batch_size: int = 32, window: int = 256, embedding_format: EmbeddingFormat = None, cache: AnnotationCache = None, pool: 'InferencePool' = None, fuse: bool = False, chunking: Chunking = None, layers: Iterable[str] = None, timing: bool = False) -> Iterator[OrderedDict]:
+        """Lazily process an iterable of texts and yield one JSON-NLP document per text, in input order.
+
+        Texts are consumed in windows of `window` documents (0 pools the whole iterable). The sentences of a window
+        are pooled into length-sorted mini-batches of `batch_size`, so each model runs once per window.
+        With a cache, documents (or sentences) annotated before with the same configuration are not tagged again.
+        With an InferencePool, the models run in its worker processes. With fuse, taggers sharing embeddings
+        compute them once per batch. chunking sets a token budget per batch and splits very long sentences,
+        for book-length documents.
+
+        layers selects the annotation layers (see LAYERS) instead of the expressions, pos and sentiment switches;
+        only the models of these layers and the layers they depend on run, and embeddings are only computed for
+        the embeddings layer. The meta of each document lists the models that ran with the seconds they took
+        for the window of the document (None when they ran in a pool).
+
+        With timing, the meta of each annotated document also holds the seconds of every stage of its window
+        (cache, load, segment, tag, embed, json) and the number of documents in the window. Documents served by
+        a document cache list no models and only the cache lookup in their timing. See flairjsonnlp.metrics
+        for the aggregate metrics."""
+        if use_embeddings == 'default':
+            use_embeddings = 'glove,multi-forward,multi-backward'
+        embed_type = get_embed_type(use_embeddings, char_embeddings, bpe_size)
+        check_lang(lang)
+        if layers is not None:
+            layers = check_layers(layers)
+            model_names = plan_models(layers, lang, use_ontonotes, fast)
+        else:
+            model_names = get_model_names(lang=lang, use_ontonotes=use_ontonotes, fast=fast, expressions=expressions, pos=pos, sentiment=sentiment)
+        with_embeddings = (use_embeddings or char_embeddings or bpe_size > 0) and (layers is None or 'embeddings' in layers)
+        config = get_config(lang, use_ontonotes, fast, model_names, embed_type, embedding_format, chunking, layers)
+        if pool is not None and pool.model_names != model_names:
+            raise ValueError(f'The pool runs {pool.model_names}, but this configuration needs {model_names}.')
+        models = None
+        embeddings = None
+
+        for chunk in windows(texts, window):
+            results = [None] * len(chunk)
+            stages = OrderedDict()
+            start = time.perf_counter()
+            if cache is not None and cache.granularity == 'document':
+                keys = [cache.key(config, text) for text in chunk]
+                found = cache.get_many(keys)
+                # a copy for every position, repeated texts must not share one document
+                results = [copy.deepcopy(found[k]) if k in found else None for k in keys]
+                hits = [j for j in results if j is not None]
+                metrics.cache_requests_total.inc(len(hits), granularity='document', result='hit')
+                metrics.cache_requests_total.inc(len(keys) - len(hits), granularity='document', result='miss')
+                start = lap(stages, 'cache', start)
+                # the cache holds no per-request meta, no model ran for these documents
+                for j in hits:
+                    j['documents'][0]['meta']['models'] = OrderedDict()
+                    if timing:
+                        j['documents'][0]['meta']['timing'] = OrderedDict([('cache', stages['cache']), ('documents', len(hits))])
+            todo = [i for i, r in enumerate(results) if r is None]
+
+            if todo:
+                if models is None:
+                    models = list(load_models(model_names)) if pool is None else []
+                    if with_embeddings:
+                        embeddings = get_embeddings([e.strip() for e in use_embeddings.split(',')], char_embeddings, lang, bpe_size)
+                    start = lap(stages, 'load', start)
+                documents = {i: FlairPipeline.segment_text(chunk[i]) for i in todo}
+                sentences = [s for i in todo for s in documents[i]]
+                start = lap(stages, 'segment', start)
+                timings = {}
+                tag_sentences(models, sentences, batch_size, cache, tag_config(config), pool, fuse, chunking, timings)
+                start = lap(stages, 'tag', start)
+                if embeddings is not None:
+                    for batch in get_batches(sentences, batch_size, chunking.max_tokens if chunking else 0):
+                        embeddings.embed(batch)
+                    start = lap(stages, 'embed', start)
+                model_seconds = model_timings(model_names, models, timings)
+                # every document gets its own copies of the window's meta
+                for i in todo:
+                    results[i] = FlairPipeline.get_nlp_json(documents[i], chunk[i], embed_type, embedding_format, layers,
+                                                            {'models': OrderedDict(model_seconds)})
+                lap(stages, 'json', start)
+                if cache is not None and cache.granularity == 'document':
+                    cache.put_many([(keys[i], without_request_meta(results[i])) for i in todo])
+                if metrics.enabled():
+                    metrics.record_window(stages, model_seconds, len(todo), sentences)
+                if timing:
+                    stages['documents'] = len(todo)
+                    for i in todo:
+                        results[i]['documents'][0]['meta']['timing'] = OrderedDict(stages)
+            elif metrics.enabled() and stages:
+                metrics.stage_seconds.observe(stages['cache'], stage='cache')
+
+            yield from results
+
+    @staticmethod
+    def segment_text(text: str) -> List['Sentence']:
+        """Tokenize text into Flair sentences"""
+        from flair.data import Sentence, Token
         sentences = []
         for s in segment(text):
             sentence = Sentence()
             sentences.append(sentence)
             for t in s:
                 sentence.add_token(Token(t.value, start_position=t.offset, whitespace_after=t.space_after))
+        return sentences
+
+    @staticmethod
+    def get_sentences(text, lang, use_ontonotes, fast, use_embeddings, char_embeddings, bpe_size, expressions, pos, sentiment, chunking: Chunking = None) -> List['Sentence']:
+        """Process text using Flair and return the output from Flair"""
+
+        check_lang(lang)
+
+        # tokenize sentences
+        sentences = FlairPipeline.segment_text(text)
 
         # run models
-        for model in get_models(lang=lang, use_ontonotes=use_ontonotes, fast=fast, expressions=expressions, pos=pos, sentiment=sentiment):
-            model.predict(sentences)
+        predict_batched(list(get_models(lang=lang, use_ontonotes=use_ontonotes, fast=fast, expressions=expressions, pos=pos, sentiment=sentiment)),
+                        sentences, chunking=chunking)
 
         # load embedding models
         if use_embeddings or char_embeddings or bpe_size > 0:
@@ -97,105 +283,442 @@ class FlairPipeline(Pipeline):
         return sentences
 
     @staticmethod
-    def get_nlp_json(sentences: List[Sentence], text: str, embed_type: str) -> OrderedDict:
-        j: OrderedDict = pyjsonnlp.get_base()
-        d: OrderedDict = pyjsonnlp.get_base_document(1)
-        #j['documents'][d['id']] = d
-        j['documents'].append(d)
-        
-        d['meta']['DC.source'] = 'Flair {}'.format(flair_version)
-        d['text'] = text
-
-        # sentences
+    def get_nlp_json(sentences: List['Sentence'], text: str, embed_type: str, embedding_format: EmbeddingFormat = None, layers: Iterable[str] = None, meta: dict = None) -> OrderedDict:
+        """Build the JSON-NLP document in a single pass over the tokens.
+
+        Empty fields of the document and its meta are never written, so no cleanup pass is needed; the tokens of
+        a sentence and the scores of a token are written even when they are empty, as remove_empty_fields kept them.
+        layers selects the annotation layers to write (see LAYERS), None writes all of them. meta is added to the
+        meta of the document."""
+        layers = LAYERS if layers is None else frozenset(layers)
+        with_upos = 'upos' in layers
+        with_xpos = 'pos' in layers
+        with_ner = 'ner' in layers
+        with_frame = 'frame' in layers
+        with_labels = 'sentiment' in layers
+        with_embeddings = 'embeddings' in layers and embed_type != 'Flair '
+
+        token_list = []
+        sents = {}
+        expressions = []
+        vectors = []
         token_id = 1
         for i, s in enumerate(sentences):
             sent = {
                 'id': i,
                 'tokenFrom': token_id,
                 'tokenTo': token_id + len(s),
-                'tokens': []
+                'tokens': list(range(token_id, token_id + len(s)))
             }
-            d['sentences'][sent['id']] = sent
+            sents[i] = sent
 
             # sentiment and any other classifiers
-            for label in s.labels:
-                if 'labels' not in sent:
-                    sent['labels'] = []
-                sent['labels'].append({
+            if with_labels and s.labels:
+                sent['labels'] = [{
                     'type': 'sentiment' if label.value in ('POSITIVE', 'NEGATIVE') else 'offensive language',
                     'label': label.value,
                     'scores': {'label': label.score}
-                })
+                } for label in s.labels]
 
             # syntactic chunking (expressions)
-            d['expressions'] = [{
-                'type': span.tag,
-                'scores': {'type': span.score},
-                'tokens': [t.idx + token_id - 1 for t in span.tokens]
-            } for span in s.get_spans('np') if len(span.tokens) > 1]
-
-            # features for each token
+            if 'expressions' in layers:
+                expressions.extend({
+                    'type': span.tag,
+                    'scores': {'type': span.score},
+                    'tokens': [t.idx + token_id - 1 for t in span.tokens]
+                } for span in s.get_spans('np') if len(span.tokens) > 1)
+
+            # features for each token, reading all tag layers at once
+            previous_entity = None
             for token in s:
+                tags = token.tags
+                scores = {}
                 t = {
                     'id': token_id,
                     'text': token.text,
                     'characterOffsetBegin': token.start_pos,
                     'characterOffsetEnd': token.end_pos,
                     'features': {'Overt': True},
-                    'scores': {},
+                    'scores': scores,
                     'misc': {'SpaceAfter': True if token.whitespace_after else False}
                 }
 
-                # pos
-                pos = token.get_tag('upos')  # 'multi' models give universal pos tags
-                if pos.value:
-                    t['upos'] = pos.value
-                    t['scores']['upos'] = pos.score
-                pos = token.get_tag('pos')
-                if pos.value:
-                    t['xpos'] = pos.value
-                    t['scores']['xpos'] = pos.score
-                #print(token_id -1, d['tokenList'])
-                
+                # pos, 'multi' models give universal pos tags
+                upos = tags.get('upos')
+                if with_upos and upos is not None and upos.value:
+                    t['upos'] = upos.value
+                    scores['upos'] = upos.score
+                if with_xpos:
+                    pos = tags.get('pos')
+                    if pos is not None and pos.value:
+                        t['xpos'] = pos.value
+                        scores['xpos'] = pos.score
+
                 # named entities
-                entity = token.get_tag('ner')
-                if entity.value != 'O':
-                    t['entity'] = entity.value
-                    #print(token_id, len(d['tokenList']))
-                    e = d['tokenList'][token_id-2].get('entity') if token.idx != 1 else None
-                    #e = None
-                    t['entity_iob'] = 'B' if e != entity.value else 'I'
-                    t['scores']['entity'] = entity.score
-                else:
-                    t['entity_iob'] = 'O'
-
-                # semantic frames (wordnet)
-                frame = token.get_tag('frame')
-                if frame.value and frame.value != '_':
-                    f = frame.value.split('.')
-                    w_id = '.'.join([f[0], t['upos'][0].lower(), f[1]])
-                    t['synsets'] = {
-                        w_id: {
-                            'wordnetId': w_id,
-                            'scores': {'wordnetId': frame.score}
-                        }}
+                if with_ner:
+                    entity = tags.get('ner')
+                    if entity is not None:
+                        if entity.value != 'O':
+                            t['entity'] = entity.value
+                            t['entity_iob'] = 'B' if previous_entity != entity.value else 'I'
+                            scores['entity'] = entity.score
+                            previous_entity = entity.value
+                        else:
+                            t['entity_iob'] = 'O'
+                            previous_entity = None
+
+                # semantic frames (wordnet), the synset id needs the universal pos
+                if with_frame:
+                    frame = tags.get('frame')
+                    if frame is not None and frame.value and frame.value != '_' and upos is not None and upos.value:
+                        f = frame.value.split('.')
+                        w_id = '.'.join([f[0], upos.value[0].lower(), f[1]])
+                        t['synsets'] = {
+                            w_id: {
+                                'wordnetId': w_id,
+                                'scores': {'wordnetId': frame.score}
+                            }}
 
                 # word embeddings
-                if embed_type != 'Flair ':
-                    t['embeddings'] = [{
-                        'model': embed_type,
-                        'vector': token.embedding.tolist()
-                    }]
-
-                d['tokenList'].append(t)
-                sent['tokens'].append(token_id)
+                if with_embeddings:
+                    if embedding_format is None:
+                        t['embeddings'] = [{
+                            'model': embed_type,
+                            'vector': token.embedding.tolist()
+                        }]
+                    else:
+                        t['embeddings'] = [{'model': embed_type, 'index': len(vectors)}]
+                        vectors.append(token.embedding)
+
+                token_list.append(t)
                 token_id += 1
 
-        return pyjsonnlp.remove_empty_fields(j)
+        content = {
+            'text': text,
+            'tokenList': token_list,
+            'sentences': sents,
+            'expressions': expressions,
+        }
+        # one contiguous array for all token vectors of the document
+        if vectors:
+            import torch
+            content['embeddings'] = [embedding_format.pack(torch.stack(vectors).cpu().numpy(), embed_type)]
+
+        d = OrderedDict()
+        for k, v in pyjsonnlp.get_base_document(1).items():
+            v = content.pop(k, v)
+            if k == 'meta':
+                v = without_empty_fields(v)
+                v['DC.source'] = 'Flair {}'.format(get_flair_version())
+                if meta:
+                    v.update(meta)
+            if not is_empty(v):
+                d[k] = v
+        d.update((k, v) for k, v in content.items() if not is_empty(v))
+
+        j = OrderedDict()
+        for k, v in pyjsonnlp.get_base().items():
+            if k == 'documents':
+                j[k] = [d]
+            else:
+                v = without_empty_fields(v) if isinstance(v, dict) else v
+                if not is_empty(v):
+                    j[k] = v
+        return j
+
+    @staticmethod
+    def process_incremental(previous: OrderedDict, text: str, lang='en', use_ontonotes=False, fast=True, use_embeddings='', char_embeddings=False, bpe_size: int = 0, expressions=False, pos=True, sentiment=True, batch_size: int = 32, embedding_format: EmbeddingFormat = None, pool: 'InferencePool' = None, fuse: bool = False, chunking: Chunking = None, layers: Iterable[str] = None) -> OrderedDict:
+        """Re-annotate an edited text, running the models only on the sentences that changed.
+
+        previous is the JSON-NLP of an earlier version of the text, processed with the same parameters. The
+        sentences of both are matched on their tokens with difflib; sentences found in previous keep their tags
+        (and vectors), the others are tagged. Token ids, character offsets and sentence ranges are those of the
+        new text. layers is as in process_iter."""
+        if use_embeddings == 'default':
+            use_embeddings = 'glove,multi-forward,multi-backward'
+        embed_type = get_embed_type(use_embeddings, char_embeddings, bpe_size)
+        check_lang(lang)
+        if layers is not None:
+            layers = check_layers(layers)
+            model_names = plan_models(layers, lang, use_ontonotes, fast)
+        else:
+            model_names = get_model_names(lang=lang, use_ontonotes=use_ontonotes, fast=fast, expressions=expressions, pos=pos, sentiment=sentiment)
+        if pool is not None and pool.model_names != model_names:
+            raise ValueError(f'The pool runs {pool.model_names}, but this configuration needs {model_names}.')
+
+        sentences = FlairPipeline.segment_text(text)
+        d = previous['documents'][0]
+        old = previous_sentences(d)
+        chunks = expression_tags(d)
+        matcher = difflib.SequenceMatcher(None, [tuple(t['text'] for t in tokens) for tokens, _ in old],
+                                          [tuple(t.text for t in s) for s in sentences], autojunk=False)
+        changed = []
+        kept = []
+        models = []
+        timings = {}
+        for op, i1, i2, j1, j2 in matcher.get_opcodes():
+            if op == 'equal':
+                for i, j in zip(range(i1, i2), range(j1, j2)):
+                    load_tags(sentences[j], tags_from_json(old[i][0], old[i][1], chunks))
+                    kept.append((sentences[j], old[i][0]))
+            else:
+                changed.extend(sentences[j1:j2])
+        if changed:
+            models = list(load_models(model_names)) if pool is None else []
+            tag_sentences(models, changed, batch_size, pool=pool, fuse=fuse, chunking=chunking, timings=timings)
+
+        if (use_embeddings or char_embeddings or bpe_size > 0) and (layers is None or 'embeddings' in layers):
+            # vectors cut to fewer dimensions cannot be reused next to full ones
+            arrays = token_vectors(d, embed_type) if embedding_format is None or not embedding_format.dims else None
+            missing = changed + [s for s, tokens in kept if arrays is None or not load_vectors(s, tokens, arrays, embed_type)]
+            embeddings = get_embeddings([e.strip() for e in use_embeddings.split(',')], char_embeddings, lang, bpe_size)
+            for batch in get_batches(missing, batch_size, chunking.max_tokens if chunking else 0):
+                embeddings.embed(batch)
+        # only the models that ran on changed sentences
+        meta = {'models': model_timings(model_names, models, timings) if changed else OrderedDict()}
+        return FlairPipeline.get_nlp_json(sentences, text, embed_type, embedding_format, layers, meta)
+
+    @staticmethod
+    def process_bytes(text='', **kwargs) -> bytes:
+        """Process text and return the JSON-NLP serialized to UTF-8 bytes"""
+        return dumps(FlairPipeline.process(text, **kwargs))
+
+
+def is_empty(v) -> bool:
+    return v is None or v == '' or v == [] or v == {}
+
+
+def without_empty_fields(v):
+    """Drop empty values from the small template dicts of pyjsonnlp"""
+    if isinstance(v, dict):
+        v = OrderedDict((k, without_empty_fields(x)) for k, x in v.items())
+        return OrderedDict((k, x) for k, x in v.items() if not is_empty(x))
+    return v
+
+
+def dumps(j: OrderedDict) -> bytes:
+    """Serialize JSON-NLP to compact UTF-8 bytes, with orjson if it is installed.
+
+    Both give the same bytes for strings, ints, finite floats, booleans, None, lists and dicts with string or int
+    keys, which is all get_nlp_json writes. They differ on NaN and infinity (null with orjson, NaN and Infinity
+    with json) and on numpy scalars and other objects, which are written with str by orjson."""
+    if orjson is not None:
+        return orjson.dumps(j, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(j, default=str, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def check_lang(lang: str):
+    if lang not in ('en', 'multi', 'de', 'nl', 'fr'):
+        raise TypeError(
+            f'{lang} is not supported! Try multi. See https://github.com/zalandoresearch/flair/blob/master/resources/docs/TUTORIAL_2_TAGGING.md')
+
+
+def get_embed_type(use_embeddings: str, char_embeddings: bool, bpe_size: int) -> str:
+    """The embedding model description written to the JSON-NLP output"""
+    if bpe_size not in (0, 50, 100, 200, 300):
+        raise ValueError(f'bpe_size must be one of 0, 50, 100, 200, 300. {bpe_size} is not allowed.')
+    return f'Flair {use_embeddings}' + (',char' if char_embeddings else '') + (f',byte-pair_{bpe_size}' if bpe_size > 0 else '')
+
+
+def windows(items: Iterable, size: int) -> Iterator[list]:
+    """Split an iterable into lists of at most size items, 0 means everything in one list"""
+    if size <= 0:
+        yield list(items)
+        return
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def lap(stages: dict, stage: str, start: float) -> float:
+    """Store the seconds since start as the time of stage and return the current time"""
+    now = time.perf_counter()
+    stages[stage] = now - start
+    return now
+
+
+def get_batches(sentences: List['Sentence'], batch_size: int, max_tokens: int = 0) -> Iterator[List['Sentence']]:
+    """Mini-batches of sentences sorted by length, to keep padding low.
+
+    With max_tokens, a batch also ends before its padded size (sentences times the longest) exceeds max_tokens."""
+    ordered = sorted((s for s in sentences if len(s) > 0), key=len, reverse=True)
+    if max_tokens <= 0:
+        for i in range(0, len(ordered), batch_size):
+            yield ordered[i:i + batch_size]
+        return
+    batch = []
+    for s in ordered:
+        if batch and (len(batch) == batch_size or (len(batch) + 1) * len(batch[0]) > max_tokens):
+            yield batch
+            batch = []
+        batch.append(s)
+    if batch:
+        yield batch
+
+
+def predict_batched(models: List['Model'], sentences: List['Sentence'], batch_size: int = 32, fuse: bool = False, chunking: Chunking = None, timings: dict = None):
+    """Run every model over the sentences in length-sorted mini-batches.
+
+    With fuse, taggers sharing token embeddings run back to back on each batch and the shared embeddings are
+    computed once per batch, see predict_fused. With chunking, the batches have a token budget, sentences longer
+    than its max_length are tagged in parts and the batches may run in parallel threads. The seconds spent in
+    each model are added to timings, keyed on the model."""
+    parts = []
+    if chunking is not None:
+        sentences, parts = chunking.split(sentences)
+    batches = list(get_batches(sentences, batch_size, chunking.max_tokens if chunking else 0))
+    if metrics.enabled():
+        for batch in batches:
+            metrics.observe_batch(batch)
+    if fuse:
+        models = fusion_order(models)
+    if chunking is not None and chunking.threads > 1:
+        def run(batch):
+            t = {}
+            if fuse:
+                predict_fused(models, batch, batch_size, t)
+            else:
+                for model in models:
+                    predict(model, batch, batch_size, t)
+            return t
+
+        with ThreadPoolExecutor(max_workers=chunking.threads) as executor:
+            for t in executor.map(run, batches):
+                if timings is not None:
+                    for model, seconds in t.items():
+                        timings[model] = timings.get(model, 0.0) + seconds
+    elif fuse:
+        for batch in batches:
+            predict_fused(models, batch, batch_size, timings)
+    else:
+        for model in models:
+            for batch in batches:
+                predict(model, batch, batch_size, timings)
+    Chunking.merge(parts)
+
+
+def predict(model: 'Model', batch: List['Sentence'], batch_size: int, timings: dict = None, **kwargs):
+    """model.predict, adding the seconds it took to timings"""
+    start = time.perf_counter()
+    model.predict(batch, mini_batch_size=batch_size, **kwargs)
+    if timings is not None:
+        timings[model] = timings.get(model, 0.0) + time.perf_counter() - start
+
+
+def embedding_fingerprint(embedding) -> tuple:
+    """Identify the weights of a token embedding, so that only identical embeddings are shared"""
+    fingerprint = getattr(embedding, '_flairjsonnlp_fingerprint', None)
+    if fingerprint is None:
+        import torch
+        parts = [embedding.name]
+        with torch.no_grad():
+            for p in embedding.parameters():
+                parts.append((tuple(p.shape), float(p.flatten()[:64].sum())))
+        vectors = getattr(getattr(embedding, 'precomputed_word_embeddings', None), 'vectors', None)
+        if vectors is not None:
+            parts.append((vectors.shape, float(vectors[:4].sum())))
+        fingerprint = tuple(parts)
+        embedding._flairjsonnlp_fingerprint = fingerprint
+    return fingerprint
+
+
+def embedding_keys(model: 'Model') -> dict:
+    """The token embeddings of a sequence tagger by name, with None for the ones that are computed anew on every
+    call and so cannot be shared; empty for models that cannot share embeddings"""
+    from flair.embeddings import StackedEmbeddings
+    from flair.models import SequenceTagger
+    if not isinstance(model, SequenceTagger):
+        return {}
+    stack = model.embeddings.embeddings if isinstance(model.embeddings, StackedEmbeddings) else [model.embeddings]
+    return {e.name: embedding_fingerprint(e) if getattr(e, 'static_embeddings', False) else None for e in stack}
+
+
+def fusion_order(models: List['Model']) -> List['Model']:
+    """Order the models so that each one shares as many embeddings as possible with the ones before"""
+    keys = [{k for k in embedding_keys(m).items() if k[1] is not None} for m in models]
+    remaining = list(range(len(models)))
+    order = [remaining.pop(0)] if remaining else []
+    seen = set(keys[order[0]]) if order else set()
+    while remaining:
+        best = max(remaining, key=lambda i: len(seen & keys[i]))
+        remaining.remove(best)
+        order.append(best)
+        seen |= keys[best]
+    return [models[i] for i in order]
+
+
+def predict_fused(models: List['Model'], batch: List['Sentence'], batch_size: int, timings: dict = None):
+    """Run the models over one batch, computing every token embedding they share only once.
+
+    SequenceTagger.predict clears the token embeddings before tagging, so the taggers run through tag_batch
+    instead. Flair concatenates all embeddings stored on a token, so each tagger starts from tokens holding just
+    the embeddings it shares with the taggers before it, which its embeddings then do not compute again. Its own
+    new embeddings are kept for the taggers after it. Afterwards all are cleared."""
+    stored = {}
+    for model in models:
+        for sentence in batch:
+            sentence.clear_embeddings()
+        keys = embedding_keys(model)
+        if not keys:
+            predict(model, batch, batch_size, timings)
+            continue
+        for name, key in keys.items():
+            vectors = stored.get((name, key))
+            if vectors is not None:
+                for token, vector in zip((t for s in batch for t in s), vectors):
+                    token.set_embedding(name, vector)
+        tag_batch(model, batch, timings)
+        for name, key in keys.items():
+            if key is not None and (name, key) not in stored:
+                stored[(name, key)] = [t._embeddings[name] for s in batch for t in s]
+    for sentence in batch:
+        sentence.clear_embeddings()
+
+
+def tag_batch(model: 'SequenceTagger', batch: List['Sentence'], timings: dict = None):
+    """Tag one batch with a sequence tagger as its predict does, but using the token embeddings already stored on
+    the tokens, which predict clears. The decoding step differs between the Flair versions."""
+    import torch
+    start = time.perf_counter()
+    sentences = sorted(model._filter_empty_sentences(batch), key=len, reverse=True)
+    if sentences:
+        parameters = inspect.signature(model._obtain_labels).parameters
+        with torch.no_grad():
+            if 'lengths' in parameters:
+                # Flair 0.4.1
+                tags, _ = model.forward_labels_and_loss(sentences, sort=False)
+            elif 'transitions' in parameters:
+                # Flair 0.4.4 and later
+                transitions = model.transitions.detach().cpu().numpy() if model.use_crf else None
+                tags, _ = model._obtain_labels(feature=model.forward(sentences), batch_sentences=sentences,
+                                               transitions=transitions, get_all_tags=False)
+            elif 'get_all_tags' in parameters:
+                # Flair 0.4.3
+                tags, _ = model._obtain_labels(model.forward(sentences), sentences, get_all_tags=False)
+            else:
+                # Flair 0.4.2
+                tags = model._obtain_labels(model.forward(sentences), sentences)
+        for sentence, sentence_tags in zip(sentences, tags):
+            for token, tag in zip(sentence.tokens, sentence_tags):
+                token.add_tag_label(model.tag_type, tag)
+    if timings is not None:
+        timings[model] = timings.get(model, 0.0) + time.perf_counter() - start
+
 
+def get_embeddings(embeddings: List[str], character: bool, lang: str, bpe_size: int) -> 'StackedEmbeddings':
+    """Return a cached embedding model, constructing it on first use"""
+    key = EmbeddingRegistry.key(embeddings, character, lang, bpe_size)
+    return embedding_registry.get(key, lambda: build_embeddings(embeddings, character, lang, bpe_size))
 
-def get_embeddings(embeddings: List[str], character: bool, lang: str, bpe_size: int) -> StackedEmbeddings:
+
+def build_embeddings(embeddings: List[str], character: bool, lang: str, bpe_size: int) -> 'StackedEmbeddings':
     """To Construct and return a embedding model"""
+    from flair.embeddings import StackedEmbeddings, WordEmbeddings, FlairEmbeddings, CharacterEmbeddings, BytePairEmbeddings
     stack = []
     for e in embeddings:
         if e != '':
@@ -211,32 +734,228 @@ def get_embeddings(embeddings: List[str], character: bool, lang: str, bpe_size:
     return StackedEmbeddings(embeddings=stack)
 
 
-def get_models(lang: str, use_ontonotes: bool, fast: bool, expressions: bool, pos: bool, sentiment: bool) -> Generator[Model, None, None]:
-    """Yield all relevant models"""
+def preload(use_embeddings='default', char_embeddings=False, lang='en', bpe_size: int = 0) -> 'StackedEmbeddings':
+    """Load an embedding configuration into the registry ahead of the first request"""
+    if use_embeddings == 'default':
+        use_embeddings = 'glove,multi-forward,multi-backward'
+    get_embed_type(use_embeddings, char_embeddings, bpe_size)
+    return get_embeddings([e.strip() for e in use_embeddings.split(',')], char_embeddings, lang, bpe_size)
+
+
+def get_layer_model(layer: str, lang: str, use_ontonotes: bool, fast: bool) -> Tuple[str, str]:
+    """The (kind, name) of the model tagging a layer in a language, None if there is none"""
+    suffix = '-fast' if fast else ''
+    if layer == 'upos':
+        return 'sequence', 'pos-multi' + suffix  # For universal pos tags
     if lang == 'en':
-        if pos:
-            yield get_sequence_model('pos-fast' if fast else 'pos')  # xpos
-        yield get_sequence_model(('ner-ontonotes' if use_ontonotes else 'ner') + ('-fast' if fast else ''))
-        yield get_sequence_model('frame-fast' if fast else 'frame')
-        if expressions:
-            yield get_sequence_model('chunk-fast' if fast else 'chunk')
-        if sentiment:
-            yield get_classifier_model('en-sentiment')
-    elif lang == 'de':
-        if pos:
-            yield get_sequence_model('de-pos')  # xpos
-        yield get_sequence_model('de-ner-germeval')
-        if sentiment:
-            yield get_classifier_model('de-offensive-language')
-    elif lang == 'fr':
-        yield get_sequence_model('fr-ner')
-    elif lang == 'nl':
-        yield get_sequence_model('nl-ner')
-    else:
-        yield get_sequence_model('ner-multi-fast' if fast else 'ner-multi')
+        return {
+            'pos': ('sequence', 'pos' + suffix),  # xpos
+            'ner': ('sequence', ('ner-ontonotes' if use_ontonotes else 'ner') + suffix),
+            'frame': ('sequence', 'frame' + suffix),
+            'expressions': ('sequence', 'chunk' + suffix),
+            'sentiment': ('classifier', 'en-sentiment'),
+        }.get(layer)
+    if lang == 'de':
+        return {
+            'pos': ('sequence', 'de-pos'),  # xpos
+            'ner': ('sequence', 'de-ner-germeval'),
+            'sentiment': ('classifier', 'de-offensive-language'),
+        }.get(layer)
+    if lang in ('fr', 'nl'):
+        return ('sequence', f'{lang}-ner') if layer == 'ner' else None
+    return ('sequence', 'ner-multi' + suffix) if layer == 'ner' else None
+
+
+def check_layers(layers: Iterable[str]) -> frozenset:
+    layers = frozenset(layers)
+    if not layers <= LAYERS:
+        raise ValueError(f'Unknown layers {sorted(layers - LAYERS)}, use {", ".join(sorted(LAYERS))}.')
+    return layers
+
+
+def get_layers(expressions: bool, pos: bool, sentiment: bool) -> frozenset:
+    """The layers of the expressions, pos and sentiment switches"""
+    return frozenset(l for l, on in (('upos', True), ('pos', pos), ('ner', True), ('frame', True), ('expressions', expressions),
+                                     ('sentiment', sentiment), ('embeddings', True)) if on)
+
+
+def plan_models(layers: Iterable[str], lang: str, use_ontonotes: bool, fast: bool) -> List[Tuple[str, str]]:
+    """The (kind, name) of the models to run for the layers, including the layers they depend on.
+
+    Layers without a model in the language are skipped."""
+    layers = check_layers(layers)
+    needed = set(layers)
+    for layer in layers:
+        if get_layer_model(layer, lang, use_ontonotes, fast) is not None:
+            needed.update(LAYER_DEPENDENCIES.get(layer, ()))
+    names = []
+    for layer in MODEL_ORDER:
+        name = get_layer_model(layer, lang, use_ontonotes, fast) if layer in needed else None
+        if name is not None:
+            names.append(name)
+    return names
+
+
+def model_timings(model_names: List[Tuple[str, str]], models: List['Model'], timings: dict) -> OrderedDict:
+    """The seconds each model spent tagging by model name, None for models that ran in a pool"""
+    if not models:
+        return OrderedDict((name, None) for _, name in model_names)
+    return OrderedDict((name, timings.get(model, 0.0)) for (_, name), model in zip(model_names, models))
+
+
+def get_model_names(lang: str, use_ontonotes: bool, fast: bool, expressions: bool, pos: bool, sentiment: bool) -> List[Tuple[str, str]]:
+    """The (kind, name) of all relevant models, kind is sequence or classifier"""
+    return plan_models(get_layers(expressions, pos, sentiment), lang, use_ontonotes, fast)
+
+
+def load_models(names: List[Tuple[str, str]]) -> Generator['Model', None, None]:
+    for kind, model_name in names:
+        yield get_classifier_model(model_name) if kind == 'classifier' else get_sequence_model(model_name)
+
+
+def get_models(lang: str, use_ontonotes: bool, fast: bool, expressions: bool, pos: bool, sentiment: bool) -> Generator['Model', None, None]:
+    """Yield all relevant models"""
+    yield from load_models(get_model_names(lang, use_ontonotes, fast, expressions, pos, sentiment))
+
+
+def get_config(lang: str, use_ontonotes: bool, fast: bool, model_names: List[Tuple[str, str]], embed_type: str, embedding_format: EmbeddingFormat = None, chunking: Chunking = None, layers: Iterable[str] = None) -> OrderedDict:
+    """Everything besides the text that determines the annotation, e.g. for cache keys"""
+    return OrderedDict([
+        ('lang', lang),
+        ('use_ontonotes', use_ontonotes),
+        ('fast', fast),
+        ('models', model_names),
+        ('layers', None if layers is None else sorted(layers)),
+        ('embeddings', embed_type),
+        ('embedding_format', None if embedding_format is None else
+            [embedding_format.encoding, embedding_format.dtype, embedding_format.dims]),
+        # only the parts of long sentences can change the tags, not the batching
+        ('chunking', None if chunking is None or chunking.max_length <= 0 else [chunking.max_length, chunking.overlap]),
+        ('backend', backend),
+        ('flair', get_flair_version()),
+        ('flairjsonnlp', __version__),
+    ])
+
+
+def tag_config(config: OrderedDict) -> OrderedDict:
+    """The part of a configuration that determines the tags of a sentence, for sentence cache keys"""
+    return OrderedDict((k, v) for k, v in config.items() if k not in ('layers', 'embeddings', 'embedding_format'))
+
+
+def without_request_meta(j: OrderedDict) -> OrderedDict:
+    """A copy of a JSON-NLP document without the meta that describes the request rather than the text, for caching"""
+    d = OrderedDict(j['documents'][0])
+    d['meta'] = OrderedDict((k, v) for k, v in d['meta'].items() if k not in REQUEST_META)
+    j = OrderedDict(j)
+    j['documents'] = [d]
+    return j
+
+
+def dump_tags(sentence: 'Sentence') -> Tuple[list, list]:
+    """The tags of every token and the labels of a sentence as plain values"""
+    return ([{tag_type: (tag.value, tag.score) for tag_type, tag in token.tags.items()} for token in sentence],
+            [(label.value, label.score) for label in sentence.labels])
+
+
+def load_tags(sentence: 'Sentence', tags: Tuple[list, list]):
+    """Restore tags and labels produced by dump_tags"""
+    from flair.data import Label
+    token_tags, labels = tags
+    for token, t in zip(sentence, token_tags):
+        for tag_type, (value, score) in t.items():
+            token.add_tag(tag_type, value, score)
+    for value, score in labels:
+        sentence.add_label(Label(value, score))
+
+
+def previous_sentences(d: dict) -> List[Tuple[list, list]]:
+    """The tokens and labels of every sentence of a JSON-NLP document, in order"""
+    tokens = {t['id']: t for t in d.get('tokenList', [])}
+    # the sentence ids are strings once the document went through JSON
+    ordered = sorted(d.get('sentences', {}).values(), key=lambda s: int(s['id']))
+    return [([tokens[i] for i in range(s['tokenFrom'], s['tokenTo'])], s.get('labels', [])) for s in ordered]
+
+
+def expression_tags(d: dict) -> dict:
+    """The chunk tag of every token id in the expressions of a JSON-NLP document"""
+    chunks = {}
+    for e in d.get('expressions', []):
+        ids = e['tokens']
+        for k, i in enumerate(ids):
+            prefix = 'B' if k == 0 else 'E' if k == len(ids) - 1 else 'I'
+            chunks[i] = (f'{prefix}-{e["type"]}', e['scores']['type'])
+    return chunks
+
+
+def tags_from_json(tokens: List[dict], labels: List[dict], chunks: dict) -> Tuple[list, list]:
+    """The tags and labels of a sentence of a JSON-NLP document, as returned by dump_tags"""
+    token_tags = []
+    for t in tokens:
+        scores = t.get('scores', {})
+        tags = {}
+        if 'upos' in t:
+            tags['upos'] = (t['upos'], scores.get('upos', 0.0))
+        if 'xpos' in t:
+            tags['pos'] = (t['xpos'], scores.get('xpos', 0.0))
+        if 'entity' in t:
+            tags['ner'] = (t['entity'], scores.get('entity', 0.0))
+        elif t.get('entity_iob') == 'O':
+            tags['ner'] = ('O', 0.0)
+        for w_id, synset in t.get('synsets', {}).items():
+            # lemma.pos.sense back to the frame lemma.sense
+            lemma, p, sense = w_id.split('.')
+            tags['frame'] = (f'{lemma}.{sense}', synset['scores']['wordnetId'])
+            if 'upos' not in tags:
+                # upos ran for the frames but was not written, its initial is all the wordnet id needs
+                tags['upos'] = (p, 0.0)
+        if t['id'] in chunks:
+            tags['np'] = chunks[t['id']]
+        token_tags.append(tags)
+    return token_tags, [(label['label'], label['scores']['label']) for label in labels]
+
+
+def load_vectors(sentence: 'Sentence', tokens: List[dict], arrays: list, embed_type: str) -> bool:
+    """Set the token vectors of a sentence from its tokens in a JSON-NLP document, False if any is missing"""
+    import flair
+    import torch
+    vectors = []
+    for t in tokens:
+        e = next((e for e in t.get('embeddings', []) if e['model'] == embed_type), None)
+        if e is not None and 'vector' in e:
+            vectors.append(e['vector'])
+        elif e is not None and 'index' in e and e['index'] < len(arrays):
+            vectors.append(arrays[e['index']])
+        else:
+            return False
+    for token, v in zip(sentence, vectors):
+        token.set_embedding(embed_type, torch.tensor(v, dtype=torch.float32, device=flair.device))
+    return True
+
+
+def tag_sentences(models: List['Model'], sentences: List['Sentence'], batch_size: int = 32, cache: AnnotationCache = None, config: OrderedDict = None, pool: 'InferencePool' = None, fuse: bool = False, chunking: Chunking = None, timings: dict = None):
+    """Run the models, or the worker pool, over the sentences, reusing the tags of cached sentences"""
+    def run(ss):
+        if pool is not None:
+            pool.tag(ss, chunking)
+        else:
+            predict_batched(models, ss, batch_size, fuse, chunking, timings)
+
+    if cache is None or cache.granularity != 'sentence':
+        run(sentences)
+        return
+    keys = [cache.key(config, [t.text for t in s]) for s in sentences]
+    found = cache.get_many(keys)
+    metrics.cache_requests_total.inc(len(found), granularity='sentence', result='hit')
+    metrics.cache_requests_total.inc(len(keys) - len(found), granularity='sentence', result='miss')
+    missing = []
+    for s, k in zip(sentences, keys):
+        if k in found:
+            load_tags(s, found[k])
+        else:
+            missing.append((s, k))
+    run([s for s, _ in missing])
+    cache.put_many([(k, dump_tags(s)) for s, k in missing])
 
-    # For universal pos tags
-    yield get_sequence_model('pos-multi-fast' if fast else 'pos-multi')
 
 if __name__ == "__main__":
     test_text = "The Mueller Report is a very long report. We spent a long time analyzing it. Trump wishes we didn't, but that didn't stop the intrepid NlpLab."
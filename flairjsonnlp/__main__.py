@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""
+(C) 2019-2020 Damir Cavar
+
+Command line interface: python -m flairjsonnlp [input] [-o output]
+
+Licensed under the Apache License 2.0, see the file LICENSE for more details.
+
+Brought to you by the NLP-Lab.org (https://nlp-lab.org/)!
+"""
+
+import argparse
+import sys
+
+from flairjsonnlp import BACKENDS, LAYERS, check_layers, set_backend
+from flairjsonnlp.cache import AnnotationCache, GRANULARITIES
+from flairjsonnlp.chunking import Chunking
+from flairjsonnlp.stream import read_documents, stream, write_jsonl, Progress
+from flairjsonnlp.vectors import EmbeddingFormat, VectorStore, DTYPES
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='flairjsonnlp', description='Annotate a corpus with Flair and write JSON-NLP documents as JSONL.')
+    parser.add_argument('input', nargs='?', default='-', help='input file, - for stdin (default)')
+    parser.add_argument('-o', '--output', default='-', help='output file, - for stdout (default)')
+    parser.add_argument('-f', '--format', default='jsonl', choices=('jsonl', 'lines', 'text'),
+                        help='jsonl: one JSON object per line, lines: one document per line, text: documents separated by blank lines')
+    parser.add_argument('--field', default='text', help='the text field of jsonl input')
+    parser.add_argument('--lang', default='en')
+    parser.add_argument('--ontonotes', action='store_true', help='use the 12-class OntoNotes NER model')
+    parser.add_argument('--full', action='store_true', help='use the full models instead of the fast ones')
+    parser.add_argument('--embeddings', default='', help='comma separated embeddings, or default')
+    parser.add_argument('--char-embeddings', action='store_true')
+    parser.add_argument('--bpe-size', type=int, default=0)
+    parser.add_argument('--vectors', default='inline', choices=('inline', 'base64', 'sidecar'),
+                        help='inline: a list of floats per token, base64: one array per document, sidecar: one array per document in --vectors-file')
+    parser.add_argument('--vectors-file', help='the binary file the sidecar vectors are appended to')
+    parser.add_argument('--vectors-dtype', default='float32', choices=DTYPES)
+    parser.add_argument('--vectors-dims', type=int, help='keep only the first n dimensions')
+    parser.add_argument('--expressions', action='store_true')
+    parser.add_argument('--no-pos', action='store_true')
+    parser.add_argument('--no-sentiment', action='store_true')
+    parser.add_argument('--layers', help=f'comma separated layers to annotate, of {", ".join(sorted(LAYERS))}; '
+                                         f'overrides --expressions, --no-pos and --no-sentiment')
+    parser.add_argument('--backend', default='fp32', choices=BACKENDS, help='int8 runs dynamically quantized models on CPU')
+    parser.add_argument('--batch-size', type=int, default=32, help='sentences per model mini-batch')
+    parser.add_argument('--window', type=int, default=64, help='documents held in memory at a time')
+    parser.add_argument('--fuse', action='store_true', help='compute embeddings shared by several taggers once per batch')
+    parser.add_argument('--workers', type=int, default=0, help='run the models in this many worker processes, 0 runs them in-process')
+    parser.add_argument('--threads', type=int, default=1, help='torch intra-op threads per worker process')
+    parser.add_argument('--max-tokens', type=int, default=0, help='tokens per mini-batch including padding, 0 for no budget')
+    parser.add_argument('--max-length', type=int, default=0, help='tag sentences longer than this in overlapping parts, 0 for no limit')
+    parser.add_argument('--overlap', type=int, default=32, help='tokens shared by neighbouring parts of a long sentence')
+    parser.add_argument('--batch-threads', type=int, default=1, help='tag mini-batches in this many parallel threads')
+    parser.add_argument('--cache', help='SQLite file caching annotations across runs')
+    parser.add_argument('--cache-granularity', default='document', choices=GRANULARITIES)
+    parser.add_argument('--cache-size', type=int, default=2 ** 30, help='maximum bytes of cached annotations')
+    parser.add_argument('--progress', type=float, default=10.0, help='seconds between progress reports on stderr, 0 disables them')
+    args = parser.parse_args(argv)
+
+    if args.window <= 0:
+        parser.error('--window must be positive to keep memory bounded')
+    if args.vectors == 'sidecar' and not args.vectors_file:
+        parser.error('--vectors sidecar needs --vectors-file')
+    if args.vectors_dims is not None and args.vectors_dims <= 0:
+        parser.error('--vectors-dims must be positive')
+    embedding_format = None
+    if args.vectors != 'inline':
+        embedding_format = EmbeddingFormat(args.vectors, args.vectors_dtype, args.vectors_dims,
+                                           VectorStore(args.vectors_file) if args.vectors_file else None)
+
+    set_backend(args.backend)
+    layers = None
+    if args.layers:
+        try:
+            layers = check_layers(l.strip() for l in args.layers.split(','))
+        except ValueError as e:
+            parser.error(str(e))
+
+    chunking = None
+    if args.max_tokens > 0 or args.max_length > 0 or args.batch_threads > 1:
+        try:
+            chunking = Chunking(args.max_tokens, args.max_length, args.overlap, args.batch_threads)
+        except ValueError as e:
+            parser.error(str(e))
+
+    cache = AnnotationCache(args.cache, args.cache_size, args.cache_granularity) if args.cache else None
+
+    pool = None
+    if args.workers > 0:
+        from flairjsonnlp.pool import InferencePool
+        pool = InferencePool(lang=args.lang, use_ontonotes=args.ontonotes, fast=not args.full, expressions=args.expressions,
+                             pos=not args.no_pos, sentiment=not args.no_sentiment, workers=args.workers, threads=args.threads,
+                             batch_size=args.batch_size, fuse=args.fuse, layers=layers)
+
+    fin = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    fout = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    progress = Progress(every=args.progress) if args.progress > 0 else None
+    try:
+        documents = stream(read_documents(fin, args.format, args.field), progress=progress, lang=args.lang, use_ontonotes=args.ontonotes,
+                           fast=not args.full, use_embeddings=args.embeddings, char_embeddings=args.char_embeddings,
+                           bpe_size=args.bpe_size, expressions=args.expressions, pos=not args.no_pos,
+                           sentiment=not args.no_sentiment, batch_size=args.batch_size, window=args.window,
+                           embedding_format=embedding_format, cache=cache, pool=pool, fuse=args.fuse, chunking=chunking, layers=layers)
+        write_jsonl(documents, fout)
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
+        if fout is not sys.stdout:
+            fout.close()
+        if cache is not None:
+            cache.close()
+        if pool is not None:
+            pool.close()
+    if progress is not None:
+        progress.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+"""
+(C) 2019-2020 Damir Cavar
+
+An asyncio microservice that collects concurrent requests into micro-batches for FlairPipeline.process_many.
+
+Requires aiohttp: pip install flairjsonnlp[async]
+
+Licensed under the Apache License 2.0, see the file LICENSE for more details.
+
+Brought to you by the NLP-Lab.org (https://nlp-lab.org/)!
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+from aiohttp import web
+
+from flairjsonnlp import FlairPipeline, check_layers, dumps
+from flairjsonnlp.metrics import BATCH_BUCKETS, CONTENT_TYPE, from_env, metrics
+from flairjsonnlp.warmup import load_manifest, warm_up as warm_up_manifest
+
+logger = logging.getLogger(__name__)
+
+# request parameters passed on to FlairPipeline.process_many
+BOOL_PARAMS = ('use_ontonotes', 'fast', 'char_embeddings', 'expressions', 'pos', 'sentiment', 'timing',
+               'coreferences', 'constituents', 'dependencies')
+INT_PARAMS = ('bpe_size',)
+TRUE = ('1', 'true', 'yes', 'on')
+FALSE = ('0', 'false', 'no', 'off', '')
+DEFAULTS = {'lang': 'en', 'use_ontonotes': False, 'fast': True, 'use_embeddings': '', 'char_embeddings': False, 'bpe_size': 0,
+            'expressions': True, 'pos': True, 'sentiment': True, 'layers': None, 'timing': False,
+            # accepted as by the Flask microservice, Flair has none of these
+            'coreferences': False, 'constituents': False, 'dependencies': False}
+
+queue_depth = metrics.gauge('flairjsonnlp_queue_depth', 'Requests waiting for a micro-batch')
+micro_batch_texts = metrics.histogram('flairjsonnlp_micro_batch_texts', 'Texts per micro-batch', buckets=BATCH_BUCKETS)
+request_seconds = metrics.histogram('flairjsonnlp_request_seconds', 'Seconds from receiving a request to its response', ('route',))
+
+
+class Overloaded(Exception):
+    """The request queue is full"""
+
+
+class MicroBatcher:
+    """Collect submitted texts into batches of at most max_batch_size, waiting at most max_wait_ms for a batch to fill.
+
+    Texts with the same parameters are processed together with one call of `process(texts, **params)` in the
+    executor, and every request's future is resolved with its own document. At most max_queue requests wait;
+    submitting beyond that raises Overloaded."""
+
+    def __init__(self, process: Callable = FlairPipeline.process_many, max_batch_size: int = 32, max_wait_ms: float = 10,
+                 max_queue: int = 1024, executor: ThreadPoolExecutor = None):
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self._queue = None
+        self._task = None
+        self.batches = 0
+        self.processed = 0
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=False)
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, text: str, params: dict):
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self._queue.put_nowait((tuple(sorted(params.items())), text, future))
+        except asyncio.QueueFull:
+            raise Overloaded()
+        return await future
+
+    async def _collect(self) -> List[Tuple[tuple, str, asyncio.Future]]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._collect()
+            groups = {}
+            for key, text, future in batch:
+                groups.setdefault(key, []).append((text, future))
+            for key, items in groups.items():
+                items = [(text, future) for text, future in items if not future.cancelled()]
+                if not items:
+                    continue
+                try:
+                    documents = await loop.run_in_executor(self.executor, lambda: self.process([t for t, _ in items], **dict(key)))
+                except Exception as e:
+                    for _, future in items:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, future), document in zip(items, documents):
+                    if not future.done():
+                        future.set_result(document)
+                micro_batch_texts.observe(len(items))
+                self.batches += 1
+                self.processed += len(items)
+
+
+def parse_params(query: dict) -> dict:
+    """The process_many parameters of a request, from the query string, a form or a JSON body.
+
+    Values may be strings or, from JSON, booleans, integers and lists of layers. Raises ValueError for unknown
+    parameters and for values of the wrong type."""
+    unknown = set(query) - set(DEFAULTS) - {'text'}
+    if unknown:
+        raise ValueError(f'Unknown parameters {sorted(unknown)}, use text, {", ".join(DEFAULTS)}.')
+    params = dict(DEFAULTS)
+    for k, v in query.items():
+        if k == 'text':
+            continue
+        if k in BOOL_PARAMS:
+            params[k] = parse_bool(k, v)
+        elif k in INT_PARAMS:
+            params[k] = parse_int(k, v)
+        elif k == 'layers':
+            params[k] = parse_layers(v)
+        elif isinstance(v, str):
+            params[k] = v
+        else:
+            raise ValueError(f'{k} must be a string, not {v!r}.')
+    return params
+
+
+def parse_bool(k: str, v) -> bool:
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, int) and v in (0, 1):
+        return bool(v)
+    if isinstance(v, str) and v.lower() in TRUE + FALSE:
+        return v.lower() in TRUE
+    raise ValueError(f'{k} must be a boolean, not {v!r}.')
+
+
+def parse_int(k: str, v) -> int:
+    if isinstance(v, int) and not isinstance(v, bool):
+        return v
+    if isinstance(v, str) and v.strip().lstrip('-').isdigit():
+        return int(v)
+    raise ValueError(f'{k} must be an integer, not {v!r}.')
+
+
+def parse_layers(v) -> tuple:
+    """Layers as a list or a comma separated string, None or empty for the default layers"""
+    if v is None:
+        return None
+    if isinstance(v, str):
+        v = [l.strip() for l in v.split(',') if l.strip()]
+    if not isinstance(v, list) or not all(isinstance(l, str) for l in v):
+        raise ValueError(f'layers must be a list or a comma separated string of layers, not {v!r}.')
+    return tuple(sorted(check_layers(v))) if v else None
+
+
+def create_app(batcher: MicroBatcher = None, warm_up: dict = None, manifest: dict = None) -> web.Application:
+    """The aiohttp application; warm_up holds the parameters of the models to load before reporting ready,
+    manifest a warm-up manifest whose models are loaded first. Metrics are recorded and served on /metrics
+    unless FLAIRJSONNLP_METRICS=0."""
+    metrics.enable(from_env(True))
+    app = web.Application()
+    app['batcher'] = batcher or MicroBatcher()
+    app['ready'] = False
+    app['warm_up_report'] = None
+
+    async def annotate(request: web.Request, **overrides) -> web.Response:
+        start = time.perf_counter()
+        query = dict(request.query)
+        if request.method == 'POST':
+            if request.content_type == 'application/json':
+                try:
+                    body = await request.json()
+                except ValueError:
+                    return web.json_response({'error': 'The body is not valid JSON'}, status=400)
+                if not isinstance(body, dict):
+                    return web.json_response({'error': 'The body must be a JSON object'}, status=400)
+                query.update(body)
+            else:
+                query.update(await request.post())
+        text = query.get('text')
+        if not text or not isinstance(text, str):
+            return web.json_response({'error': 'No text provided'}, status=400)
+        try:
+            params = parse_params(query)
+        except ValueError as e:
+            return web.json_response({'error': str(e)}, status=400)
+        params.update(overrides)
+        try:
+            document = await app['batcher'].submit(text, params)
+        except Overloaded:
+            return web.json_response({'error': 'Too many requests'}, status=503, headers={'Retry-After': '1'})
+        except (TypeError, ValueError) as e:
+            return web.json_response({'error': str(e)}, status=400)
+        request_seconds.observe(time.perf_counter() - start, route=request.path)
+        return web.Response(body=dumps(document), content_type='application/json')
+
+    async def expressions(request):
+        return await annotate(request, expressions=True)
+
+    async def token_list(request):
+        return await annotate(request, expressions=False, sentiment=False)
+
+    async def health(request):
+        return web.json_response({'status': 'ok', 'queue': app['batcher'].depth,
+                                  'batches': app['batcher'].batches, 'processed': app['batcher'].processed})
+
+    async def ready(request):
+        return web.json_response({'ready': app['ready'], 'warm_up': app['warm_up_report']}, status=200 if app['ready'] else 503)
+
+    async def prometheus(request):
+        queue_depth.set(app['batcher'].depth)
+        return web.Response(body=metrics.prometheus().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+    async def on_startup(app):
+        app['batcher'].start()
+
+        async def warm():
+            try:
+                if manifest is not None:
+                    app['warm_up_report'] = await asyncio.get_event_loop().run_in_executor(None, warm_up_manifest, manifest)
+                if warm_up is not None:
+                    params = dict(DEFAULTS)
+                    params.update(warm_up)
+                    await app['batcher'].submit('Warming up.', params)
+                app['ready'] = True
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # never ready, /ready shows why
+                logger.exception('Warming up failed')
+                report = dict(app['warm_up_report'] or {})
+                report['error'] = f'{type(e).__name__}: {e}'
+                app['warm_up_report'] = report
+
+        app['warm_up'] = asyncio.ensure_future(warm())
+
+    async def on_cleanup(app):
+        app['warm_up'].cancel()
+        await app['batcher'].stop()
+
+    for path, handler in (('/', annotate), ('/expressions', expressions), ('/token_list', token_list)):
+        app.router.add_get(path, handler)
+        app.router.add_post(path, handler)
+    app.router.add_get('/health', health)
+    app.router.add_get('/ready', ready)
+    app.router.add_get('/metrics', prometheus)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-batching Flair JSON-NLP microservice')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--max-batch-size', type=int, default=32, help='texts per batch')
+    parser.add_argument('--max-wait-ms', type=float, default=10, help='how long to wait for a batch to fill')
+    parser.add_argument('--max-queue', type=int, default=1024, help='waiting requests before answering 503')
+    parser.add_argument('--lang', default='en', help='the language to warm up')
+    parser.add_argument('--manifest', help='a warm-up manifest of the models to load at startup')
+    args = parser.parse_args(argv)
+    batcher = MicroBatcher(max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms, max_queue=args.max_queue)
+    manifest = load_manifest(args.manifest) if args.manifest else None
+    web.run_app(create_app(batcher, warm_up={'lang': args.lang}, manifest=manifest), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""
+(C) 2019-2020 Damir Cavar
+
+Benchmark of FlairPipeline.process_iter: docs/sec, tokens/sec, latency percentiles, peak RSS and the seconds of
+every stage and model as reported by its timing meta, swept over batch size, document length and model set. A model
+set is a set of annotation layers, its models are planned by plan_models like for any request.
+
+By default the taggers are small, randomly initialised models on hashed word embeddings, registered in the model
+registry in place of the pretrained ones, so the benchmark runs offline; --real loads the pretrained models instead.
+
+    python -m flairjsonnlp.benchmark --batch-sizes 8,32 --doc-sentences 1,10,50 --model-sets ner,full -o bench.json
+    python -m flairjsonnlp.benchmark ... --compare baseline.json --tolerance 0.1
+
+Licensed under the Apache License 2.0, see the file LICENSE for more details.
+
+Brought to you by the NLP-Lab.org (https://nlp-lab.org/)!
+"""
+
+import argparse
+import contextlib
+import json
+import platform
+import random
+import resource
+import sys
+import time
+import zlib
+from collections import OrderedDict
+from typing import Iterable, List, Tuple
+
+import flair
+import torch
+from flair.data import Dictionary
+from flair.embeddings import TokenEmbeddings, DocumentRNNEmbeddings, StackedEmbeddings
+from flair.models import SequenceTagger, TextClassifier
+
+from flairjsonnlp import (FlairPipeline, MODEL_ORDER, check_layers, embedding_registry, get_layer_model, model_key, model_registry,
+                           plan_models, __version__)
+from flairjsonnlp.registry import EmbeddingRegistry
+
+TAGS = OrderedDict([
+    ('pos', ['NN', 'NNS', 'VB', 'VBZ', 'DT', 'JJ', 'IN', 'PRP', '.']),
+    ('upos', ['NOUN', 'VERB', 'DET', 'ADJ', 'ADP', 'PRON', 'PUNCT']),
+    ('ner', ['O', 'S-PER', 'B-LOC', 'E-LOC', 'S-ORG', 'S-MISC']),
+    ('frame', ['_', 'be.01', 'have.01', 'shift.01', 'crash.01']),
+    ('np', ['O', 'B-NP', 'I-NP', 'E-NP', 'S-NP', 'S-VP']),
+])
+# the layers of each model set
+MODEL_SETS = OrderedDict([
+    ('ner', ('upos', 'ner')),
+    ('tagging', ('upos', 'pos', 'ner', 'frame')),
+    ('full', ('upos', 'pos', 'ner', 'frame', 'expressions', 'sentiment')),
+])
+# the tag type of the stub model of a layer, if it is not the layer itself
+STUB_TAGS = {'expressions': 'np'}
+WORDS = ('the a report people cars insurance liability manufacturers countryside time France Berlin '
+         'is are was spent analyzing shift crash afraid long very intrepid autonomous of from toward that they will').split()
+
+
+class StubEmbeddings(TokenEmbeddings):
+    """Random but fixed word vectors by hashing the token text, no download needed"""
+
+    def __init__(self, dim: int = 64, buckets: int = 4096):
+        super().__init__()
+        self.name = f'stub-{dim}'
+        self.static_embeddings = True
+        self.buckets = buckets
+        self.dim = dim
+        self.embedding = torch.nn.Embedding(buckets, dim)
+        self.to(flair.device)
+
+    @property
+    def embedding_length(self) -> int:
+        return self.dim
+
+    def _add_embeddings_internal(self, sentences):
+        for sentence in sentences:
+            ids = torch.tensor([zlib.crc32(t.text.encode('utf-8')) % self.buckets for t in sentence], device=flair.device)
+            for token, vector in zip(sentence, self.embedding(ids)):
+                token.set_embedding(self.name, vector)
+        return sentences
+
+
+def stub_model(tag_type: str, hidden_size: int = 32):
+    """A randomly initialised tagger or sentiment classifier"""
+    torch.manual_seed(len(tag_type))
+    if tag_type == 'sentiment':
+        labels = Dictionary(add_unk=False)
+        for label in ('POSITIVE', 'NEGATIVE'):
+            labels.add_item(label)
+        embeddings = DocumentRNNEmbeddings([StubEmbeddings()], hidden_size=hidden_size)
+        model = TextClassifier(document_embeddings=embeddings, label_dictionary=labels, multi_label=False)
+    else:
+        tags = Dictionary(add_unk=False)
+        for tag in TAGS[tag_type]:
+            tags.add_item(tag)
+        model = SequenceTagger(hidden_size=hidden_size, embeddings=StackedEmbeddings([StubEmbeddings()]),
+                               tag_dictionary=tags, tag_type=tag_type, use_crf=False)
+    model.eval()
+    return model
+
+
+def make_corpus(docs: int, sentences: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(docs):
+        corpus.append(' '.join(' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 25))).capitalize() + '.'
+                               for _ in range(sentences)))
+    return corpus
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+@contextlib.contextmanager
+def stub_models(layers: Iterable[str], lang: str, fast: bool, use_embeddings: str = ''):
+    """Register stub models under the names of the models of the layers, and stub embeddings under use_embeddings,
+    while the block runs. Models loaded under these names before are dropped from the registries."""
+    planned = plan_models(layers, lang, False, fast)
+    models = []
+    for layer in MODEL_ORDER:
+        kind_name = get_layer_model(layer, lang, False, fast)
+        if kind_name in planned:
+            key = model_key(*kind_name)
+            model_registry.unload(key)
+            model_registry.get(key, lambda: stub_model(STUB_TAGS.get(layer, layer)))
+            models.append(key)
+    embeddings = None
+    if use_embeddings:
+        embeddings = EmbeddingRegistry.key([use_embeddings], False, lang, 0)
+        embedding_registry.unload(embeddings)
+        embedding_registry.get(embeddings, lambda: StackedEmbeddings([StubEmbeddings(dim=300)]))
+    try:
+        yield
+    finally:
+        for key in models:
+            model_registry.unload(key)
+        if embeddings is not None:
+            embedding_registry.unload(embeddings)
+
+
+def run_documents(texts: List[str], layers: frozenset, lang: str, fast: bool, batch_size: int, use_embeddings: str = '') -> Tuple[int, OrderedDict]:
+    """Annotate the texts with FlairPipeline.process_iter as one window, and return the number of tokens and the
+    seconds of every stage and model"""
+    documents = list(FlairPipeline.process_iter(texts, lang=lang, fast=fast, use_embeddings=use_embeddings, batch_size=batch_size,
+                                                window=0, layers=layers, timing=True))
+    meta = documents[0]['documents'][0]['meta']
+    stages = OrderedDict((stage, seconds) for stage, seconds in meta['timing'].items() if stage != 'documents')
+    for model_name, seconds in meta['models'].items():
+        stages[f'predict:{model_name}'] = seconds
+    return sum(len(d['documents'][0]['tokenList']) for d in documents), stages
+
+
+def benchmark(layers: frozenset, lang: str, fast: bool, batch_size: int, doc_sentences: int, docs: int, latency_docs: int, use_embeddings: str = '') -> OrderedDict:
+    corpus = make_corpus(docs, doc_sentences)
+    run_documents(corpus[:2], layers, lang, fast, batch_size, use_embeddings)  # warm up, loads the models
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        tokens, stages = run_documents(corpus, layers, lang, fast, batch_size, use_embeddings)
+    elapsed = time.perf_counter() - start
+
+    latencies = []
+    with torch.no_grad():
+        for text in corpus[:latency_docs]:
+            start = time.perf_counter()
+            run_documents([text], layers, lang, fast, batch_size, use_embeddings)
+            latencies.append(time.perf_counter() - start)
+
+    return OrderedDict([
+        ('batch_size', batch_size),
+        ('doc_sentences', doc_sentences),
+        ('docs', docs),
+        ('tokens', tokens),
+        ('seconds', elapsed),
+        ('docs_per_sec', docs / elapsed),
+        ('tokens_per_sec', tokens / elapsed),
+        ('latency_p50', percentile(latencies, 50)),
+        ('latency_p95', percentile(latencies, 95)),
+        ('latency_p99', percentile(latencies, 99)),
+        ('peak_rss', peak_rss()),
+        ('stages', OrderedDict(sorted(stages.items()))),
+    ])
+
+
+def compare(results: List[dict], baseline: List[dict], tolerance: float) -> List[str]:
+    """Configurations whose throughput dropped by more than tolerance against the baseline"""
+    key = lambda r: (r['model_set'], r['batch_size'], r['doc_sentences'])
+    before = {key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = before.get(key(r))
+        if b is not None and r['docs_per_sec'] < b['docs_per_sec'] * (1 - tolerance):
+            regressions.append(f'{key(r)}: {r["docs_per_sec"]:.2f} docs/sec, baseline {b["docs_per_sec"]:.2f}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='flairjsonnlp.benchmark', description='Benchmark the FlairPipeline hot path.')
+    parser.add_argument('--batch-sizes', default='8,32', help='comma separated mini-batch sizes')
+    parser.add_argument('--doc-sentences', default='1,10,50', help='comma separated document lengths in sentences')
+    parser.add_argument('--model-sets', default=','.join(MODEL_SETS), help=f'comma separated, of {", ".join(MODEL_SETS)}')
+    parser.add_argument('--docs', type=int, default=50, help='documents per configuration')
+    parser.add_argument('--latency-docs', type=int, default=20, help='documents processed one at a time for the latency percentiles')
+    parser.add_argument('--embeddings', action='store_true', help='also write token embeddings to the output')
+    parser.add_argument('--real', action='store_true', help='use the pretrained models (needs them downloaded) instead of stubs')
+    parser.add_argument('--accurate', action='store_true', help='use the slower models instead of the -fast ones, for every model set')
+    parser.add_argument('--lang', default='en', help='the language of the pretrained models')
+    parser.add_argument('-o', '--output', default='-', help='JSON results, - for stdout')
+    parser.add_argument('--compare', help='baseline results to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative drop in docs/sec')
+    args = parser.parse_args(argv)
+
+    fast = not args.accurate
+    use_embeddings = ('glove' if args.real else 'stub') if args.embeddings else ''
+    results = []
+    for model_set in args.model_sets.split(','):
+        if model_set not in MODEL_SETS:
+            parser.error(f'Unknown model set {model_set}, use {", ".join(MODEL_SETS)}.')
+        layers = check_layers(MODEL_SETS[model_set] + (('embeddings',) if args.embeddings else ()))
+        with contextlib.nullcontext() if args.real else stub_models(layers, args.lang, fast, use_embeddings):
+            for batch_size in map(int, args.batch_sizes.split(',')):
+                for doc_sentences in map(int, args.doc_sentences.split(',')):
+                    r = benchmark(layers, args.lang, fast, batch_size, doc_sentences, args.docs, args.latency_docs, use_embeddings)
+                    r['model_set'] = model_set
+                    r.move_to_end('model_set', last=False)
+                    results.append(r)
+                    print(f'{model_set} batch_size={batch_size} doc_sentences={doc_sentences}: '
+                          f'{r["docs_per_sec"]:.2f} docs/sec, {r["tokens_per_sec"]:.0f} tokens/sec, p95 {r["latency_p95"] * 1000:.1f}ms',
+                          file=sys.stderr)
+
+    report = OrderedDict([
+        ('flairjsonnlp', __version__),
+        ('python', platform.python_version()),
+        ('torch', torch.__version__),
+        ('threads', torch.get_num_threads()),
+        ('stub_models', not args.real),
+        ('fast', fast),
+        ('results', results),
+    ])
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    json.dump(report, out, indent=2)
+    out.write('\n')
+    if out is not sys.stdout:
+        out.close()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        for r in regressions:
+            print(f'REGRESSION {r}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
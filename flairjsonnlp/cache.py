@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""
+(C) 2019-2020 Damir Cavar
+
+A persistent, content-addressed cache of annotations in SQLite, keyed by the text and the pipeline configuration.
+
+Licensed under the Apache License 2.0, see the file LICENSE for more details.
+
+Brought to you by the NLP-Lab.org (https://nlp-lab.org/)!
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Tuple
+
+GRANULARITIES = ('document', 'sentence')
+
+
+class AnnotationCache:
+    """Cache whole JSON-NLP documents, or the tags of single sentences, on disk.
+
+    With `granularity='sentence'` documents that share sentences reuse their cached tags and only the new sentences
+    are tagged. Once the stored values exceed max_bytes the least recently used ones are deleted.
+
+    Values are stored as JSON, so anyone who can write the file can change the annotations but cannot run code.
+    Tuples come back as lists and the integer keys of objects, e.g. sentence ids, as ints. Rows that are not JSON,
+    e.g. written by an older version, are misses."""
+
+    def __init__(self, path: str, max_bytes: int = 2 ** 30, granularity: str = 'document'):
+        if granularity not in GRANULARITIES:
+            raise ValueError(f'granularity must be one of {", ".join(GRANULARITIES)}. {granularity} is not allowed.')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.granularity = granularity
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS annotations (key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS annotations_used ON annotations (used)')
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM annotations').fetchone()[0]
+
+    @staticmethod
+    def key(*parts) -> str:
+        """A stable hash of JSON serializable parts"""
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Any:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._db.execute(f'SELECT key, value FROM annotations WHERE key IN ({",".join("?" * len(chunk))})', chunk).fetchall()
+                for k, v in rows:
+                    try:
+                        found[k] = loads(v)
+                    except ValueError:
+                        pass
+            if found:
+                with self._db:
+                    self._db.executemany('UPDATE annotations SET used = ? WHERE key = ?', [(time.time(), k) for k in found])
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, key: str, value: Any):
+        self.put_many([(key, value)])
+
+    def put_many(self, items: List[Tuple[str, Any]]):
+        now = time.time()
+        rows = [(k, dumps(v)) for k, v in items]
+        with self._lock, self._db:
+            for k, v in rows:
+                old = self._db.execute('SELECT size FROM annotations WHERE key = ?', (k,)).fetchone()
+                self._size += len(v) - (old[0] if old else 0)
+                self._db.execute('INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?)', (k, v, len(v), now))
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes:
+            rows = self._db.execute('SELECT key, size FROM annotations ORDER BY used LIMIT 100').fetchall()
+            if not rows:
+                self._size = 0
+                break
+            for k, size in rows:
+                self._db.execute('DELETE FROM annotations WHERE key = ?', (k,))
+                self._size -= size
+                if self._size <= self.max_bytes:
+                    break
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM annotations')
+            self._size = 0
+
+    def close(self):
+        self._db.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._db.execute('SELECT COUNT(*) FROM annotations').fetchone()[0]
+        return {
+            'entries': entries,
+            'bytes': self._size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+def dumps(value: Any) -> bytes:
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def loads(data: bytes) -> Any:
+    return json.loads(data.decode('utf-8'), object_pairs_hook=_object)
+
+
+def _object(pairs: List[Tuple[str, Any]]) -> OrderedDict:
+    # JSON turns int keys into strings
+    return OrderedDict((int(k) if k.isascii() and k.isdigit() else k, v) for k, v in pairs)
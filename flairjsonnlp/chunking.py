@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+(C) 2019-2020 Damir Cavar
+
+Long document mode: mini-batches with a token budget, and very long sentences tagged in overlapping parts whose tags
+are merged back onto the original tokens.
+
+Licensed under the Apache License 2.0, see the file LICENSE for more details.
+
+Brought to you by the NLP-Lab.org (https://nlp-lab.org/)!
+"""
+
+from typing import List, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from flair.data import Sentence
+
+# an original sentence with its parts and the (begin, end) of the tokens each part is responsible for
+Parts = List[Tuple['Sentence', List[Tuple['Sentence', int, int]]]]
+
+
+class Chunking:
+    """How long documents are tagged.
+
+    Mini-batches hold at most max_tokens tokens including padding (0 means no budget). Sentences longer than
+    max_length tokens (0 means no limit) are tagged in parts of max_length tokens that overlap by `overlap`
+    tokens; each token keeps the tags of the part in which it has at least overlap / 2 tokens of context on
+    both sides. With threads > 1 the mini-batches are tagged in parallel threads."""
+
+    def __init__(self, max_tokens: int = 4096, max_length: int = 256, overlap: int = 32, threads: int = 1):
+        if max_tokens < 0 or max_length < 0 or threads < 1:
+            raise ValueError('max_tokens and max_length cannot be negative and threads must be positive.')
+        if max_length > 0 and not 0 <= overlap < max_length // 2:
+            raise ValueError(f'overlap must be less than half of max_length, {overlap} is not allowed.')
+        self.max_tokens = max_tokens
+        self.max_length = max_length
+        self.overlap = overlap
+        self.threads = threads
+
+    def split(self, sentences: List['Sentence']) -> Tuple[List['Sentence'], Parts]:
+        """Replace every sentence longer than max_length by its parts.
+
+        Returns the sentences to tag and the parts to merge back afterwards with merge."""
+        if self.max_length <= 0 or all(len(s) <= self.max_length for s in sentences):
+            return sentences, []
+        from flair.data import Sentence, Token
+        stride = self.max_length - self.overlap
+        margin = self.overlap // 2
+        tagged = []
+        parts = []
+        for s in sentences:
+            n = len(s)
+            if n <= self.max_length:
+                tagged.append(s)
+                continue
+            starts = [0]
+            while starts[-1] + self.max_length < n:
+                starts.append(starts[-1] + stride)
+            pieces = []
+            for k, start in enumerate(starts):
+                part = Sentence()
+                for token in s.tokens[start:start + self.max_length]:
+                    part.add_token(Token(token.text, start_position=token.start_pos, whitespace_after=token.whitespace_after))
+                last = k == len(starts) - 1
+                begin = start + (margin if k > 0 else 0)
+                end = n if last else starts[k + 1] + margin
+                pieces.append((part, begin - start, end - start))
+                tagged.append(part)
+            parts.append((s, pieces))
+        return tagged, parts
+
+    @staticmethod
+    def merge(parts: Parts):
+        """Copy the tags of the parts onto the tokens of the original sentences.
+
+        The sentence labels are the label with the highest total score over the parts, with its mean score."""
+        from flair.data import Label
+        for sentence, pieces in parts:
+            tokens = sentence.tokens
+            offset = 0
+            totals = {}
+            for part, begin, end in pieces:
+                for token in part.tokens[begin:end]:
+                    for tag_type, tag in token.tags.items():
+                        tokens[offset].add_tag(tag_type, tag.value, tag.score)
+                    offset += 1
+                for label in part.labels:
+                    totals[label.value] = totals.get(label.value, 0.0) + label.score
+            if totals:
+                value = max(totals, key=totals.get)
+                sentence.add_label(Label(value, totals[value] / len(pieces)))
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+"""
+(C) 2019-2020 Damir Cavar
+
+Instrumentation of the pipeline: stage and model latency histograms, documents, sentences and tokens processed,
+mini-batch sizes, model loads, annotation cache lookups, the model registries and resident memory, exposed in the
+Prometheus text format and as a dictionary.
+
+Recording is off unless it is enabled with metrics.enable() or FLAIRJSONNLP_METRICS=1; the servers enable it unless
+FLAIRJSONNLP_METRICS=0. While it is off, every update returns right away.
+
+Licensed under the Apache License 2.0, see the file LICENSE for more details.
+
+Brought to you by the NLP-Lab.org (https://nlp-lab.org/)!
+"""
+
+import bisect
+import os
+import resource
+import sys
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536)
+
+
+class Metric:
+    """A named metric with one value per combination of label values"""
+    kind = 'untyped'
+
+    def __init__(self, metrics: 'Metrics', name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self._metrics = metrics
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = OrderedDict()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} has the labels {", ".join(self.labelnames)}, not {", ".join(labels)}.')
+        return tuple(str(labels[l]) for l in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, tuple, float]]:
+        """(suffix, label pairs, value) of every sample"""
+        return [('', tuple(zip(self.labelnames, k)), v) for k, v in self._values.items()]
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels))
+
+    def clear(self):
+        self._values.clear()
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        if not self._metrics.enabled:
+            return
+        key = self._key(labels)
+        with self._metrics.lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        """Set the total of something counted elsewhere, e.g. by a registry, at collection time"""
+        self._values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Observations counted into buckets by their upper bound, with their count and sum"""
+    kind = 'histogram'
+
+    def __init__(self, metrics: 'Metrics', name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(metrics, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        if not self._metrics.enabled:
+            return
+        key = self._key(labels)
+        with self._metrics.lock:
+            h = self._values.get(key)
+            if h is None:
+                # per bucket counts, the last one for values above all buckets, then the sum
+                h = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            h[bisect.bisect_left(self.buckets, value)] += 1
+            h[-1] += value
+
+    def samples(self) -> List[Tuple[str, tuple, float]]:
+        samples = []
+        for k, h in self._values.items():
+            labels = tuple(zip(self.labelnames, k))
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), h):
+                total += count
+                samples.append(('_bucket', labels + (('le', format_value(bound)),), total))
+            samples.append(('_count', labels, total))
+            samples.append(('_sum', labels, h[-1]))
+        return samples
+
+    def value(self, **labels):
+        """count, sum and cumulative bucket counts of the observations"""
+        h = self._values.get(self._key(labels))
+        if h is None:
+            return None
+        cumulative = []
+        for count in h[:-1]:
+            cumulative.append((cumulative[-1] if cumulative else 0) + count)
+        return OrderedDict([('count', cumulative[-1]), ('sum', h[-1]),
+                            ('buckets', OrderedDict(zip(self.buckets + (float('inf'),), cumulative)))])
+
+
+class Metrics:
+    """A set of metrics, with collectors that update gauges from other objects whenever the metrics are read"""
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self._metrics = OrderedDict()
+        self._collectors = []
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+
+    def _add(self, cls, name: str, documentation: str, labelnames: Iterable[str] = (), **kwargs) -> Metric:
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(self, name, documentation, labelnames, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f'{name} is a {metric.kind}, not a {cls.kind}.')
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._add(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._add(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def on_collect(self, collector: Callable[[], None]):
+        """Call collector before the metrics are read"""
+        self._collectors.append(collector)
+
+    def collect(self) -> List[Metric]:
+        for collector in self._collectors:
+            collector()
+        return list(self._metrics.values())
+
+    def reset(self):
+        """Drop all recorded values"""
+        with self.lock:
+            for metric in self._metrics.values():
+                metric.clear()
+
+    def snapshot(self) -> OrderedDict:
+        """The current values as {metric name: [{'labels': ..., 'value': ...}]}, histogram values as in Histogram.value"""
+        result = OrderedDict()
+        for metric in self.collect():
+            with self.lock:
+                keys = list(metric._values)
+            result[metric.name] = [{'labels': OrderedDict(zip(metric.labelnames, k)), 'value': metric.value(**dict(zip(metric.labelnames, k)))}
+                                   for k in keys]
+        return result
+
+    def prometheus(self) -> str:
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.collect():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            with self.lock:
+                samples = metric.samples()
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{k}="{escape(v)}"' for k, v in labels)
+                lines.append(f'{metric.name}{suffix}{{{label_text}}} {format_value(value)}' if labels else
+                             f'{metric.name}{suffix} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def resident_memory() -> int:
+    """Resident set size of this process in bytes, the peak where the current size is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def from_env(default: bool = False) -> bool:
+    """Whether FLAIRJSONNLP_METRICS turns recording on, default when it is not set"""
+    value = os.environ.get('FLAIRJSONNLP_METRICS')
+    return default if value is None else value.lower() not in ('', '0', 'false', 'no', 'off')
+
+
+metrics = Metrics(enabled=from_env())
+
+stage_seconds = metrics.histogram('flairjsonnlp_stage_seconds', 'Seconds per pipeline stage and window of documents', ('stage',))
+model_seconds = metrics.histogram('flairjsonnlp_model_seconds', 'Seconds each model spent tagging a window of documents', ('model',))
+documents_total = metrics.counter('flairjsonnlp_documents_total', 'Documents annotated')
+sentences_total = metrics.counter('flairjsonnlp_sentences_total', 'Sentences annotated')
+tokens_total = metrics.counter('flairjsonnlp_tokens_total', 'Tokens annotated')
+batch_sentences = metrics.histogram('flairjsonnlp_batch_sentences', 'Sentences per model mini-batch', buckets=BATCH_BUCKETS)
+batch_tokens = metrics.histogram('flairjsonnlp_batch_tokens', 'Tokens per model mini-batch including padding', buckets=TOKEN_BUCKETS)
+model_loads_total = metrics.counter('flairjsonnlp_model_loads_total', 'Models loaded', ('model', 'backend'))
+model_load_seconds = metrics.histogram('flairjsonnlp_model_load_seconds', 'Seconds to load a model', ('backend',))
+cache_requests_total = metrics.counter('flairjsonnlp_cache_requests_total', 'Annotation cache lookups', ('granularity', 'result'))
+registry_models = metrics.gauge('flairjsonnlp_registry_models', 'Models held by a registry', ('registry',))
+registry_bytes = metrics.gauge('flairjsonnlp_registry_bytes', 'Approximate bytes of the models held by a registry', ('registry',))
+registry_requests_total = metrics.counter('flairjsonnlp_registry_requests_total', 'Registry lookups', ('registry', 'result'))
+registry_evictions_total = metrics.counter('flairjsonnlp_registry_evictions_total', 'Models dropped by a registry', ('registry',))
+registry_load_seconds_total = metrics.counter('flairjsonnlp_registry_load_seconds_total', 'Seconds a registry spent loading models', ('registry',))
+resident_memory_bytes = metrics.gauge('process_resident_memory_bytes', 'Resident memory size in bytes')
+metrics.on_collect(lambda: resident_memory_bytes.set(resident_memory()))
+
+
+def enabled() -> bool:
+    return metrics.enabled
+
+
+def enable(on: bool = True):
+    """Start (or with False stop) recording"""
+    metrics.enable(on)
+
+
+def snapshot() -> OrderedDict:
+    return metrics.snapshot()
+
+
+def prometheus() -> str:
+    return metrics.prometheus()
+
+
+def reset():
+    metrics.reset()
+
+
+def watch_registry(registry_name: str, registry):
+    """Export the stats of a ModelRegistry whenever the metrics are read"""
+    def collect():
+        stats = registry.stats()
+        registry_models.set(stats['entries'], registry=registry_name)
+        registry_bytes.set(stats['bytes'], registry=registry_name)
+        registry_requests_total.set(stats['hits'], registry=registry_name, result='hit')
+        registry_requests_total.set(stats['misses'], registry=registry_name, result='miss')
+        registry_evictions_total.set(stats['evictions'], registry=registry_name)
+        registry_load_seconds_total.set(stats['load_time'], registry=registry_name)
+
+    metrics.on_collect(collect)
+
+
+def observe_batch(batch: list):
+    """Record the size of a mini-batch of sentences"""
+    if metrics.enabled and batch:
+        batch_sentences.observe(len(batch))
+        batch_tokens.observe(len(batch) * max(len(s) for s in batch))
+
+
+def record_window(stages: dict, models: dict, documents: int, sentences: list):
+    """Record a window of documents annotated by FlairPipeline.process_iter: the seconds of its stages, the seconds
+    of each model (None for models that ran in a pool), and the documents, sentences and tokens"""
+    for stage, seconds in stages.items():
+        stage_seconds.observe(seconds, stage=stage)
+    for model_name, seconds in models.items():
+        if seconds is not None:
+            model_seconds.observe(seconds, model=model_name)
+    documents_total.inc(documents)
+    sentences_total.inc(len(sentences))
+    tokens_total.inc(sum(len(s) for s in sentences))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+(C) 2019-2020 Damir Cavar
+
+A pool of worker processes that run the Flair models on CPU-only machines.
+
+Licensed under the Apache License 2.0, see the file LICENSE for more details.
+
+Brought to you by the NLP-Lab.org (https://nlp-lab.org/)!
+"""
+
+import multiprocessing
+import os
+from typing import List, Tuple
+
+import torch
+from flair.data import Sentence, Token
+
+import flairjsonnlp
+from flairjsonnlp import get_model_names, plan_models, load_models, get_batches, predict_batched, dump_tags, load_tags
+from flairjsonnlp.chunking import Chunking
+
+# the models of a worker process
+_models = None
+_fuse = False
+
+
+def _init_worker(model_names: List[Tuple[str, str]], threads: int, fuse: bool, model_dir: str, backend: str):
+    global _models, _fuse
+    torch.set_num_threads(threads)
+    _fuse = fuse
+    # a spawned or forkserver worker starts from a fresh interpreter, without the settings of the parent
+    flairjsonnlp.set_model_dir(model_dir)
+    flairjsonnlp.set_backend(backend)
+    # with fork the models are already in the registry, inherited copy-on-write from the parent
+    _models = list(load_models(model_names))
+
+
+def _tag(batch: List[List[str]]) -> List[Tuple[list, list]]:
+    sentences = []
+    for tokens in batch:
+        sentence = Sentence()
+        for text in tokens:
+            sentence.add_token(Token(text))
+        sentences.append(sentence)
+    with torch.no_grad():
+        predict_batched(_models, sentences, len(sentences), _fuse)
+    return [dump_tags(s) for s in sentences]
+
+
+class InferencePool:
+    """Tag sentences with a pool of worker processes that each load the models once.
+
+    Batches of sentences are sent to the workers through a queue and the tags come back in order. By default the
+    workers are started with forkserver (spawn where it is not available) and each loads the models in its
+    initializer; models in a model_dir are memory-mapped, so the workers still share their pages. With
+    start_method='fork' the models are loaded in the parent first and the workers share the read-only weights
+    copy-on-write, but forking a process whose torch (OpenMP) thread pool has already run can deadlock the
+    workers, so only use it in a process that has not run any model yet. `threads` sets the torch intra-op
+    threads per worker; workers * threads should not exceed the number of cores. With fuse, the workers share
+    embeddings between taggers as in predict_fused. layers selects the models as in FlairPipeline.process_iter."""
+
+    def __init__(self, lang='en', use_ontonotes=False, fast=True, expressions=False, pos=True, sentiment=True,
+                 workers: int = None, threads: int = 1, batch_size: int = 32, start_method: str = None, fuse: bool = False, layers=None):
+        if layers is not None:
+            self.model_names = plan_models(layers, lang, use_ontonotes, fast)
+        else:
+            self.model_names = get_model_names(lang=lang, use_ontonotes=use_ontonotes, fast=fast, expressions=expressions, pos=pos, sentiment=sentiment)
+        self.workers = workers or max(1, (os.cpu_count() or 1) // threads)
+        self.threads = threads
+        self.batch_size = batch_size
+        if start_method is None:
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        context = multiprocessing.get_context(start_method)
+        if start_method == 'fork':
+            list(load_models(self.model_names))
+        self._pool = context.Pool(self.workers, _init_worker, (self.model_names, threads, fuse, flairjsonnlp.model_dir, flairjsonnlp.backend))
+
+    def tag(self, sentences: List[Sentence], chunking: Chunking = None):
+        """Tag the sentences in place, with chunking splitting long sentences and setting a token budget per batch"""
+        parts = []
+        if chunking is not None:
+            sentences, parts = chunking.split(sentences)
+        batches = list(get_batches(sentences, self.batch_size, chunking.max_tokens if chunking else 0))
+        payload = [[[t.text for t in s] for s in batch] for batch in batches]
+        for batch, tags in zip(batches, self._pool.imap(_tag, payload)):
+            for sentence, t in zip(batch, tags):
+                load_tags(sentence, t)
+        Chunking.merge(parts)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+(C) 2019-2020 Damir Cavar
+
+The int8 backend: the LSTM and linear layers of the taggers dynamically quantized for CPU inference, with the converted
+models cached on disk. Select it with flairjsonnlp.set_backend('int8') or FLAIRJSONNLP_BACKEND=int8.
+
+Compare the tags and speed of both backends on a sample corpus:
+
+    python -m flairjsonnlp.quantize --lang en --corpus sample.txt
+
+Licensed under the Apache License 2.0, see the file LICENSE for more details.
+
+Brought to you by the NLP-Lab.org (https://nlp-lab.org/)!
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from typing import List
+
+import flair
+import torch
+from flair.models import SequenceTagger, TextClassifier
+
+from flairjsonnlp import FlairPipeline, LAYERS, check_layers, load_model, plan_models, predict_batched
+
+# the modules of each model that are quantized; the embeddings stay as they are
+QUANTIZED_MODULES = {
+    SequenceTagger: ('embedding2nn', 'rnn', 'linear'),
+    TextClassifier: ('decoder',),
+}
+quantized_dir = os.environ.get('FLAIRJSONNLP_QUANTIZED_DIR')
+
+
+def quantize(model):
+    """Replace the LSTM, GRU and linear layers of a tagger or classifier by dynamically quantized int8 ones, in place"""
+    names = next((n for cls, n in QUANTIZED_MODULES.items() if isinstance(model, cls)), ())
+    spec = {name: torch.quantization.default_dynamic_qconfig for name in names if getattr(model, name, None) is not None}
+    model = torch.quantization.quantize_dynamic(model, spec, dtype=torch.qint8, inplace=True)
+    model.eval()
+    return model
+
+
+def quantized_path(model_name: str, directory: str = None) -> str:
+    # a pickled module only loads with the versions that wrote it
+    directory = directory or quantized_dir or os.path.join(str(flair.cache_root), 'flairjsonnlp')
+    return os.path.join(directory, f'{model_name}.int8-flair{flair.__version__}-torch{torch.__version__}.pt')
+
+
+def load_quantized(cls, model_name: str, directory: str = None):
+    """Load the int8 version of a model, converting it and caching the result on first use"""
+    path = quantized_path(model_name, directory)
+    if os.path.exists(path):
+        try:
+            model = torch.load(path, map_location='cpu', weights_only=False)
+        except TypeError:
+            model = torch.load(path, map_location='cpu')
+        model.eval()
+        return model
+    model = quantize(load_model(cls, model_name).to('cpu'))
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # a temporary file of its own, so concurrent conversions never move a half-written file into place
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            torch.save(model, f)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return model
+
+
+def model_tags(model, sentences) -> list:
+    if isinstance(model, TextClassifier):
+        return [[label.value for label in s.labels] for s in sentences]
+    return [t.get_tag(model.tag_type).value for s in sentences for t in s]
+
+
+def compare(reference, candidate, texts: List[str], batch_size: int = 32) -> OrderedDict:
+    """Tag agreement and speedup of candidate against reference over the texts"""
+    results = []
+    for model in (reference, candidate):
+        predict_batched([model], FlairPipeline.segment_text(texts[0]), batch_size)  # warm up
+        sentences = [s for text in texts for s in FlairPipeline.segment_text(text)]
+        start = time.perf_counter()
+        with torch.no_grad():
+            predict_batched([model], sentences, batch_size)
+        results.append((time.perf_counter() - start, model_tags(model, sentences)))
+    (fp32_time, expected), (int8_time, actual) = results
+    same = sum(a == e for a, e in zip(actual, expected))
+    return OrderedDict([
+        ('items', len(expected)),
+        ('agreement', same / len(expected) if expected else 1.0),
+        ('fp32_seconds', fp32_time),
+        ('int8_seconds', int8_time),
+        ('speedup', fp32_time / int8_time if int8_time > 0 else 0.0),
+    ])
+
+
+def validate(model_names, texts: List[str], batch_size: int = 32, directory: str = None) -> List[OrderedDict]:
+    """Compare the int8 version of every model with the fp32 one"""
+    report = []
+    for kind, name in model_names:
+        cls = TextClassifier if kind == 'classifier' else SequenceTagger
+        r = compare(load_model(cls, name).to('cpu'), load_quantized(cls, name, directory), texts, batch_size)
+        r['model'] = name
+        r.move_to_end('model', last=False)
+        report.append(r)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='flairjsonnlp.quantize', description='Report tag agreement and speedup of the int8 backend.')
+    parser.add_argument('--lang', default='en')
+    parser.add_argument('--ontonotes', action='store_true', help='use the 12-class OntoNotes NER model')
+    parser.add_argument('--full', action='store_true', help='use the full models instead of the fast ones')
+    parser.add_argument('--layers', default='upos,pos,ner,frame,sentiment', help=f'comma separated, of {", ".join(sorted(LAYERS))}')
+    parser.add_argument('--corpus', help='sample texts, one per line (default: generated sentences)')
+    parser.add_argument('--docs', type=int, default=50, help='generated documents when there is no --corpus')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--dir', help='where the converted models are cached')
+    parser.add_argument('-o', '--output', default='-', help='JSON report, - for stdout')
+    args = parser.parse_args(argv)
+
+    if args.corpus:
+        with open(args.corpus, encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+    else:
+        from flairjsonnlp.benchmark import make_corpus
+        texts = make_corpus(args.docs, 5)
+    names = plan_models(check_layers(l.strip() for l in args.layers.split(',')), args.lang, args.ontonotes, not args.full)
+    report = validate(names, texts, args.batch_size, args.dir)
+    for r in report:
+        print(f'{r["model"]}: agreement {r["agreement"]:.4f}, speedup {r["speedup"]:.2f}x', file=sys.stderr)
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    json.dump(OrderedDict([('torch', torch.__version__), ('threads', torch.get_num_threads()), ('results', report)]), out, indent=2)
+    out.write('\n')
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
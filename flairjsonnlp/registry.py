@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+"""
+(C) 2019-2020 Damir Cavar
+
+Registries that keep loaded Flair models in memory and reuse them across requests.
+
+Licensed under the Apache License 2.0, see the file LICENSE for more details.
+
+Brought to you by the NLP-Lab.org (https://nlp-lab.org/)!
+"""
+
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Iterable, List, Tuple
+
+
+def model_size(model) -> int:
+    """Approximate the memory held by a model in bytes: tensors plus precomputed word vectors"""
+    size = 0
+    if hasattr(model, 'parameters'):
+        for t in itertools.chain(model.parameters(), model.buffers()):
+            size += t.numel() * t.element_size()
+    for m in (model.modules() if hasattr(model, 'modules') else [model]):
+        vectors = getattr(getattr(m, 'precomputed_word_embeddings', None), 'vectors', None)
+        if vectors is not None:
+            size += vectors.nbytes
+    return size
+
+
+class Resident:
+    """A model held by a registry, with its bookkeeping"""
+
+    def __init__(self, model, size: int, load_time: float):
+        self.model = model
+        self.size = size
+        self.load_time = load_time
+        self.loaded = time.time()
+        self.last_used = self.loaded
+        self.uses = 0
+
+
+class ModelRegistry:
+    """A thread-safe LRU cache of loaded models with a memory budget.
+
+    Once more than max_entries models are loaded, or their size exceeds max_bytes (0 means no budget), the least
+    recently used models that are not pinned are dropped. Concurrent requests for a model that is not loaded yet
+    wait for a single load instead of loading it several times."""
+
+    def __init__(self, max_entries: int = 16, max_bytes: int = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()
+        self._pinned = set()
+        self._loading = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.0
+
+    def get(self, key: Hashable, load: Callable):
+        """Return the model stored under key, loading it with load() on a miss"""
+        with self._lock:
+            model = self._use(key)
+            if model is not None:
+                return model
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                # another thread may have finished loading while we waited
+                model = self._use(key)
+                if model is not None:
+                    return model
+                self.misses += 1
+            try:
+                start = time.perf_counter()
+                model = load()
+                load_time = time.perf_counter() - start
+                resident = Resident(model, model_size(model), load_time)
+                resident.uses = 1
+                with self._lock:
+                    self.load_time += load_time
+                    self._models[key] = resident
+                    self._evict()
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+            return model
+
+    def _use(self, key: Hashable):
+        resident = self._models.get(key)
+        if resident is None:
+            return None
+        self.hits += 1
+        self._models.move_to_end(key)
+        resident.last_used = time.time()
+        resident.uses += 1
+        return resident.model
+
+    def _evict(self):
+        # the most recently used model always stays
+        for key in list(self._models)[:-1]:
+            if not (len(self._models) > self.max_entries or (0 < self.max_bytes < self.size)):
+                break
+            if key not in self._pinned:
+                del self._models[key]
+                self.evictions += 1
+
+    def pin(self, key: Hashable):
+        """Never evict the model under key"""
+        with self._lock:
+            self._pinned.add(key)
+
+    def unpin(self, key: Hashable):
+        with self._lock:
+            self._pinned.discard(key)
+            self._evict()
+
+    def unload(self, key: Hashable) -> bool:
+        """Drop the model under key, pinned or not"""
+        with self._lock:
+            self._pinned.discard(key)
+            return self._models.pop(key, None) is not None
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._models
+
+    @property
+    def size(self) -> int:
+        return sum(r.size for r in self._models.values())
+
+    def keys(self) -> List[Hashable]:
+        with self._lock:
+            return list(self._models)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+    def resident(self) -> List[dict]:
+        """The loaded models, least recently used first"""
+        with self._lock:
+            return [{
+                'key': key,
+                'bytes': r.size,
+                'pinned': key in self._pinned,
+                'uses': r.uses,
+                'loaded': r.loaded,
+                'last_used': r.last_used,
+                'load_time': r.load_time,
+            } for key, r in self._models.items()]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._models),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'load_time': self.load_time,
+            }
+
+
+class EmbeddingRegistry(ModelRegistry):
+    """A ModelRegistry for embedding stacks keyed on (embeddings, character, lang, bpe_size)"""
+
+    def __init__(self, max_entries: int = 4, max_bytes: int = 0):
+        super().__init__(max_entries=max_entries, max_bytes=max_bytes)
+
+    @staticmethod
+    def key(embeddings: Iterable[str], character: bool, lang: str, bpe_size: int) -> Tuple:
+        # the language only selects the byte-pair model
+        return tuple(e for e in embeddings if e), bool(character), lang if bpe_size > 0 else '', bpe_size
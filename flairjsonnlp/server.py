@@ -8,7 +8,15 @@ Licensed under the Apache License 2.0, see the file LICENSE for more details.
 Brought to you by the NLP-Lab.org (https://nlp-lab.org/)!
 """
 
-from flairjsonnlp import FlairPipeline
+import json
+import os
+import sys
+
+from flask import Response
+
+from flairjsonnlp import FlairPipeline, preload
+from flairjsonnlp.metrics import CONTENT_TYPE, from_env, metrics
+from flairjsonnlp.warmup import load_manifest, warm_up
 from pyjsonnlp.microservices.flask_server import FlaskMicroservice
 
 app = FlaskMicroservice(__name__, FlairPipeline(), base_route='/')
@@ -17,5 +25,18 @@ app.with_coreferences = False
 app.with_dependencies = False
 app.with_expressions = True
 
+# Prometheus metrics on /metrics, unless FLAIRJSONNLP_METRICS=0; add timing=true to a request for its stage timings
+metrics.enable(from_env(True))
+app.add_url_rule('/metrics', 'metrics', lambda: Response(metrics.prometheus(), content_type=CONTENT_TYPE))
+
+# warm up the embedding registry, e.g. FLAIRJSONNLP_EMBEDDINGS=default
+if os.environ.get('FLAIRJSONNLP_EMBEDDINGS'):
+    preload(os.environ['FLAIRJSONNLP_EMBEDDINGS'], lang=os.environ.get('FLAIRJSONNLP_LANG', 'en'))
+
+# load the models of a warm-up manifest, e.g. FLAIRJSONNLP_WARMUP=manifest.json
+if os.environ.get('FLAIRJSONNLP_WARMUP'):
+    print(json.dumps(warm_up(load_manifest(os.environ['FLAIRJSONNLP_WARMUP']))), file=sys.stderr)
+
 if __name__ == "__main__":
-    app.run(debug=True)
+    # Flask's development server, for local testing; serve the app through WSGI or use flairjsonnlp.async_server
+    app.run()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+(C) 2019-2020 Damir Cavar
+
+Streaming corpus processing: read documents lazily, annotate them in bounded windows and write JSON-NLP as JSONL.
+
+Licensed under the Apache License 2.0, see the file LICENSE for more details.
+
+Brought to you by the NLP-Lab.org (https://nlp-lab.org/)!
+"""
+
+import json
+import sys
+import time
+from collections import OrderedDict
+from typing import Iterable, Iterator, TextIO
+
+from flairjsonnlp import FlairPipeline, dumps
+
+
+def read_documents(stream: TextIO, fmt: str = 'jsonl', field: str = 'text') -> Iterator[str]:
+    """Yield the texts of a corpus one at a time.
+
+    `jsonl`: one JSON object per line, the text is in `field` (a line holding a JSON string is taken as is).
+    `lines`: one document per line.
+    `text`: documents separated by blank lines."""
+    if fmt == 'jsonl':
+        for line in stream:
+            if line.strip():
+                doc = json.loads(line)
+                yield doc if isinstance(doc, str) else doc[field]
+    elif fmt == 'lines':
+        for line in stream:
+            if line.strip():
+                yield line.rstrip('\n')
+    elif fmt == 'text':
+        paragraph = []
+        for line in stream:
+            if line.strip():
+                paragraph.append(line)
+            elif paragraph:
+                yield ''.join(paragraph).rstrip('\n')
+                paragraph = []
+        if paragraph:
+            yield ''.join(paragraph).rstrip('\n')
+    else:
+        raise ValueError(f'Unknown input format {fmt}, use jsonl, lines or text.')
+
+
+class Progress:
+    """Count documents and tokens and periodically report throughput"""
+
+    def __init__(self, out: TextIO = sys.stderr, every: float = 10.0):
+        self.out = out
+        self.every = every
+        self.docs = 0
+        self.tokens = 0
+        self.start = time.perf_counter()
+        self._last = self.start
+
+    def update(self, j: OrderedDict):
+        self.docs += 1
+        for d in j['documents']:
+            self.tokens += len(d.get('tokenList', ()))
+        now = time.perf_counter()
+        if self.out is not None and now - self._last >= self.every:
+            self._last = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        print(f'{self.docs} docs, {self.tokens} tokens in {elapsed:.1f}s '
+              f'({self.docs / elapsed:.2f} docs/sec, {self.tokens / elapsed:.1f} tokens/sec)', file=self.out, flush=True)
+
+
+def stream(texts: Iterable[str], progress: Progress = None, **kwargs) -> Iterator[OrderedDict]:
+    """Annotate texts lazily, keeping at most one window of documents in memory.
+
+    Takes the parameters of FlairPipeline.process_iter."""
+    for j in FlairPipeline.process_iter(texts, **kwargs):
+        if progress is not None:
+            progress.update(j)
+        yield j
+
+
+def write_jsonl(documents: Iterable[OrderedDict], out: TextIO):
+    """Write each JSON-NLP document on its own line as soon as it is done"""
+    for j in documents:
+        out.write(dumps(j).decode('utf-8'))
+        out.write('\n')
+        out.flush()
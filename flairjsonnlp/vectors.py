@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+(C) 2019-2020 Damir Cavar
+
+Compact storage of token embeddings in JSON-NLP: one contiguous array per document, either as a base64 blob or as an
+offset into a memory-mappable sidecar file, with tokens holding only an index into it.
+
+Licensed under the Apache License 2.0, see the file LICENSE for more details.
+
+Brought to you by the NLP-Lab.org (https://nlp-lab.org/)!
+"""
+
+import base64
+import threading
+from collections import OrderedDict
+from typing import Iterable, List, Sequence, Union
+
+import numpy as np
+
+DTYPES = ('float32', 'float16', 'int8')
+ENCODINGS = ('base64', 'sidecar')
+
+
+class VectorStore:
+    """An append-only binary file of vectors, read back with numpy.memmap"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, data: np.ndarray) -> int:
+        """Write the array and return its byte offset in the file"""
+        with self._lock:
+            with open(self.path, 'ab') as f:
+                offset = f.tell()
+                f.write(np.ascontiguousarray(data).tobytes())
+        return offset
+
+
+class EmbeddingFormat:
+    """How token embeddings are written to JSON-NLP.
+
+    encoding: `base64` stores the array in the document, `sidecar` appends it to `store` and records the offset.
+    dtype: `float32`, `float16`, or `int8`, which quantizes every vector with its own scale.
+    dims: keep only these dimensions, an int for the first n or a sequence of indices."""
+
+    def __init__(self, encoding: str = 'base64', dtype: str = 'float32', dims: Union[int, Sequence[int]] = None, store: VectorStore = None):
+        if encoding not in ENCODINGS:
+            raise ValueError(f'encoding must be one of {", ".join(ENCODINGS)}. {encoding} is not allowed.')
+        if dtype not in DTYPES:
+            raise ValueError(f'dtype must be one of {", ".join(DTYPES)}. {dtype} is not allowed.')
+        if encoding == 'sidecar' and store is None:
+            raise ValueError('The sidecar encoding needs a VectorStore.')
+        if dims is not None and (dims <= 0 if isinstance(dims, int) else len(dims) == 0):
+            raise ValueError(f'dims must keep at least one dimension, {dims} is not allowed.')
+        self.encoding = encoding
+        self.dtype = dtype
+        self.dims = dims
+        self.store = store
+
+    def pack(self, vectors: np.ndarray, model: str) -> OrderedDict:
+        """Encode a (tokens, dimensions) array as a document level embeddings entry"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2:
+            vectors = vectors.reshape(len(vectors), -1)
+        e = OrderedDict(model=model)
+        if self.dims is not None:
+            vectors = vectors[:, :self.dims] if isinstance(self.dims, int) else vectors[:, list(self.dims)]
+            e['dims'] = self.dims if isinstance(self.dims, int) else list(self.dims)
+        if self.dtype == 'int8':
+            # initial=0 for vectors without dimensions, which have no maximum
+            scale = np.abs(vectors).max(axis=1, initial=0) / 127
+            scale[scale == 0] = 1
+            data = np.rint(vectors / scale[:, None]).astype(np.int8)
+            e['scale'] = _b64(scale.astype(np.float32))
+        else:
+            data = vectors.astype(self.dtype)
+        e['dtype'] = self.dtype
+        e['shape'] = list(data.shape)
+        e['encoding'] = self.encoding
+        if self.encoding == 'base64':
+            e['data'] = _b64(data)
+        else:
+            e['path'] = self.store.path
+            e['offset'] = self.store.append(data)
+        return e
+
+
+def unpack(e: dict, mmap: bool = True) -> np.ndarray:
+    """Decode a document level embeddings entry to a float32 (tokens, dimensions) array"""
+    shape = tuple(e['shape'])
+    if e['encoding'] == 'base64':
+        data = np.frombuffer(base64.b64decode(e['data']), dtype=e['dtype']).reshape(shape)
+    elif mmap:
+        data = np.memmap(e['path'], dtype=e['dtype'], mode='r', offset=e['offset'], shape=shape)
+    else:
+        with open(e['path'], 'rb') as f:
+            f.seek(e['offset'])
+            data = np.fromfile(f, dtype=e['dtype'], count=int(np.prod(shape))).reshape(shape)
+    if e['dtype'] == 'int8':
+        scale = np.frombuffer(base64.b64decode(e['scale']), dtype=np.float32)
+        return data.astype(np.float32) * scale[:, None]
+    return data.astype(np.float32)
+
+
+def _b64(data: np.ndarray) -> str:
+    return base64.b64encode(np.ascontiguousarray(data).tobytes()).decode('ascii')
+
+
+def _values(c) -> Iterable:
+    return c.values() if isinstance(c, dict) else c
+
+
+def compact(j: OrderedDict, fmt: EmbeddingFormat) -> OrderedDict:
+    """Move inline token vectors into one array per document and embedding model, in place"""
+    for d in _values(j['documents']):
+        arrays = OrderedDict()
+        for t in _values(d.get('tokenList', [])):
+            for te in t.get('embeddings', []):
+                if 'vector' in te:
+                    vectors = arrays.setdefault(te['model'], [])
+                    te['index'] = len(vectors)
+                    vectors.append(te.pop('vector'))
+        if arrays:
+            d['embeddings'] = [fmt.pack(np.array(v, dtype=np.float32), model) for model, v in arrays.items()]
+    return j
+
+
+def inline(j: OrderedDict) -> OrderedDict:
+    """Write the vectors of compact documents back onto their tokens, in place.
+
+    Dimensions dropped by an EmbeddingFormat stay dropped."""
+    for d in _values(j['documents']):
+        arrays = {e['model']: unpack(e) for e in d.pop('embeddings', [])}
+        if not arrays:
+            continue
+        for t in _values(d.get('tokenList', [])):
+            for te in t.get('embeddings', []):
+                if 'index' in te:
+                    te['vector'] = arrays[te['model']][te.pop('index')].tolist()
+    return j
+
+
+def token_vectors(d: dict, model: str = None) -> List[np.ndarray]:
+    """The vectors of a compact document, one per token, for the first or the given embedding model"""
+    for e in d.get('embeddings', []):
+        if model is None or e['model'] == model:
+            return list(unpack(e))
+    return []
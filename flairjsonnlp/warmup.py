@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""
+(C) 2019-2020 Damir Cavar
+
+Warm-up manifests: declare the languages, model sizes and layers a deployment serves, and load all of their models in
+parallel threads at boot instead of on the first request.
+
+    {"languages": ["en", "de"], "fast": true, "layers": ["pos", "ner", "frame", "sentiment"], "threads": 4}
+
+    python -m flairjsonnlp.warmup manifest.json
+    python -m flairjsonnlp.warmup manifest.json --export /srv/models
+
+Licensed under the Apache License 2.0, see the file LICENSE for more details.
+
+Brought to you by the NLP-Lab.org (https://nlp-lab.org/)!
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from flairjsonnlp import LAYERS, check_lang, check_layers, load_models, model_key, model_registry, plan_models, preload, set_backend, set_model_dir
+
+MANIFEST_KEYS = ('languages', 'fast', 'layers', 'use_ontonotes', 'embeddings', 'threads', 'pin', 'model_dir', 'backend')
+
+
+def load_manifest(path: str) -> dict:
+    with open(path) as f:
+        manifest = json.load(f)
+    unknown = set(manifest) - set(MANIFEST_KEYS)
+    if unknown:
+        raise ValueError(f'Unknown manifest keys {sorted(unknown)}, use {", ".join(MANIFEST_KEYS)}.')
+    return manifest
+
+
+def manifest_model_names(manifest: dict) -> List[Tuple[str, str]]:
+    """The (kind, name) of every model the manifest needs, without duplicates.
+
+    `fast` is true, false or a list of both, `layers` are planned as with the layers of process."""
+    layers = check_layers(manifest.get('layers', LAYERS))
+    fast = manifest.get('fast', True)
+    names = []
+    for lang in manifest.get('languages', ['en']):
+        check_lang(lang)
+        for f in (fast if isinstance(fast, list) else [fast]):
+            for name in plan_models(layers, lang, manifest.get('use_ontonotes', False), f):
+                if name not in names:
+                    names.append(name)
+    return names
+
+
+def import_flair() -> float:
+    """Import the flair modules that are otherwise imported on first use, returning the seconds it took"""
+    start = time.perf_counter()
+    import flair.embeddings
+    import flair.models
+    return time.perf_counter() - start
+
+
+def warm_up(manifest: dict, threads: int = None) -> OrderedDict:
+    """Load the models of a manifest into the model registry and report the time spent on each step"""
+    start = time.perf_counter()
+    if 'model_dir' in manifest:
+        set_model_dir(manifest['model_dir'])
+    if 'backend' in manifest:
+        set_backend(manifest['backend'])
+    names = manifest_model_names(manifest)
+    report = OrderedDict([('import', import_flair())])
+
+    def load(name):
+        t = time.perf_counter()
+        list(load_models([name]))
+        if manifest.get('pin', False):
+            model_registry.pin(model_key(*name))
+        return time.perf_counter() - t
+
+    with ThreadPoolExecutor(max_workers=threads or manifest.get('threads', 4)) as executor:
+        times = list(executor.map(load, names))
+    report['models'] = OrderedDict((name, t) for (_, name), t in zip(names, times))
+
+    if manifest.get('embeddings'):
+        t = time.perf_counter()
+        for lang in manifest.get('languages', ['en']):
+            preload(manifest['embeddings'], lang=lang)
+        report['embeddings'] = time.perf_counter() - t
+    report['total'] = time.perf_counter() - start
+    return report
+
+
+def export_models(names: List[Tuple[str, str]], directory: str) -> List[str]:
+    """Save the models to directory as {name}.pt, to be loaded memory-mapped with set_model_dir(directory)"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for (_, name), model in zip(names, load_models(names)):
+        path = os.path.join(directory, f'{name}.pt')
+        model.save(path)
+        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='flairjsonnlp.warmup', description='Load the models of a warm-up manifest and report the timings.')
+    parser.add_argument('manifest', help=f'JSON manifest with {", ".join(MANIFEST_KEYS)}')
+    parser.add_argument('--threads', type=int, help='parallel loads, overrides the manifest')
+    parser.add_argument('--export', metavar='DIR', help='save the models to DIR for loading with FLAIRJSONNLP_MODEL_DIR')
+    args = parser.parse_args(argv)
+    manifest = load_manifest(args.manifest)
+    if args.export:
+        for path in export_models(manifest_model_names(manifest), args.export):
+            print(path, file=sys.stderr)
+        return
+    json.dump(warm_up(manifest, args.threads), sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -16,8 +16,12 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     install_requires=[
         'flair>=0.4.1',
+        'numpy',
         'pyjsonnlp>=0.2.6'
     ],
+    extras_require={
+        'async': ['aiohttp>=3.5']
+    },
     setup_requires=["pytest-runner"],
     classifiers=[
         "Programming Language :: Python :: 3",
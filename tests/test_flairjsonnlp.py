@@ -4,8 +4,21 @@ from unittest import TestCase
 from pyjsonnlp import validation
 
 from flairjsonnlp import FlairPipeline
+from flairjsonnlp.cache import AnnotationCache
+from flairjsonnlp.chunking import Chunking
+from flairjsonnlp.registry import EmbeddingRegistry, ModelRegistry
+from flairjsonnlp.vectors import EmbeddingFormat, VectorStore, compact, inline
 from . import mocks
 import pytest
+import json
+import asyncio
+import copy
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 text = "Autonomous cars from the countryside of France shift insurance liability toward manufacturers. People are afraid that they will crash."
 
@@ -61,6 +74,119 @@ class TestFlair(TestCase):
     def test_validation(self):
         assert validation.is_valid(FlairPipeline.process(text, lang='en'))
 
+    def test_expressions_all_sentences(self):
+        actual = FlairPipeline.process(text + ' ' + text, lang='en', expressions=True)
+        expressions = actual['documents'][0]['expressions']
+        half = len(actual['documents'][0]['tokenList']) // 2
+        assert any(t <= half for e in expressions for t in e['tokens'])
+        assert any(t > half for e in expressions for t in e['tokens'])
+
+    def test_empty_fields(self):
+        actual = FlairPipeline.process(text, lang='multi')
+        for t in actual['documents'][0]['tokenList']:
+            assert all(v not in ('', [], None) for v in t.values())
+            assert 'entity' not in t or t['entity']
+        # untagged tokens keep their empty scores, as remove_empty_fields only cleans the document and its meta
+        sentences = FlairPipeline.segment_text(text)
+        d = FlairPipeline.get_nlp_json(sentences, text, 'Flair ')['documents'][0]
+        assert all(t['scores'] == {} for t in d['tokenList'])
+        assert [s['tokens'] for s in d['sentences'].values()] == \
+               [list(range(s['tokenFrom'], s['tokenTo'])) for s in d['sentences'].values()]
+
+    def test_layers(self):
+        sentences = FlairPipeline.segment_text(text)
+        FlairPipeline.process(text)  # loads the models
+        from flairjsonnlp import get_models
+        for model in get_models('en', False, True, False, True, True):
+            model.predict(sentences)
+        actual = FlairPipeline.get_nlp_json(sentences, text, 'Flair ', layers={'ner'})
+        tokens = actual['documents'][0]['tokenList']
+        assert not any('upos' in t or 'xpos' in t or 'synsets' in t for t in tokens)
+        assert all('entity_iob' in t for t in tokens)
+        assert 'labels' not in actual['documents'][0]['sentences'][0]
+
+    def test_process_bytes(self):
+        actual = json.loads(FlairPipeline.process_bytes(text, lang='multi'))
+        assert actual['documents'][0]['text'] == text
+
+
+class TestFlairBatch(TestCase):
+    def test_process_many(self):
+        texts = [text, 'Ich bin ein Berliner.', text]
+        actual = FlairPipeline.process_many(texts, lang='en', fast=True, batch_size=2)
+        assert len(actual) == 3
+        for t, j in zip(texts, actual):
+            assert j['documents'][0]['text'] == t
+            assert validation.is_valid(j)
+
+    def test_process_iter(self):
+        actual = list(FlairPipeline.process_iter(iter([text] * 5), lang='multi', window=2))
+        assert len(actual) == 5
+
+    def test_invalid_language(self):
+        with pytest.raises(TypeError):
+            FlairPipeline.process_many([text], lang='martian')
+
+    def test_fuse(self):
+        expected = FlairPipeline.process(text, lang='en', fast=True, expressions=True)
+        actual = FlairPipeline.process(text, lang='en', fast=True, expressions=True, fuse=True)
+        strip = ('scores',)
+        assert [{k: v for k, v in t.items() if k not in strip} for t in actual['documents'][0]['tokenList']] == \
+               [{k: v for k, v in t.items() if k not in strip} for t in expected['documents'][0]['tokenList']]
+
+    def test_fuse_embeds_once(self):
+        from flairjsonnlp import predict_batched
+        from flairjsonnlp.benchmark import stub_model
+        models = [stub_model(tag_type) for tag_type in ('ner', 'pos', 'frame')]
+        for model in models[1:]:
+            model.embeddings = models[0].embeddings
+        embedding = models[0].embeddings.embeddings[0]
+        passes = []
+        add_embeddings = embedding._add_embeddings_internal
+
+        def counted(sentences):
+            passes.append(len(sentences))
+            return add_embeddings(sentences)
+
+        embedding._add_embeddings_internal = counted
+
+        def tags(fuse):
+            sentences = FlairPipeline.segment_text(text)
+            del passes[:]
+            predict_batched(models, sentences, batch_size=64, fuse=fuse)
+            return [[t.get_tag(m.tag_type).value for m in models for t in s] for s in sentences]
+
+        expected = tags(False)
+        assert len(passes) == len(models)
+        assert tags(True) == expected
+        assert len(passes) == 1
+
+    def test_write_jsonl(self):
+        import io
+        import flairjsonnlp
+        from flairjsonnlp.stream import write_jsonl
+        documents = [OrderedDict([('text', 'Ich bin ein Berliner.'), ('sentences', {0: {'tokens': [1, 2]}})])] * 2
+        out = io.StringIO()
+        write_jsonl(documents, out)
+        lines = out.getvalue().splitlines()
+        assert lines == [flairjsonnlp.dumps(d).decode('utf-8') for d in documents]
+        orjson, flairjsonnlp.orjson = flairjsonnlp.orjson, None
+        try:
+            assert [flairjsonnlp.dumps(d).decode('utf-8') for d in documents] == lines
+        finally:
+            flairjsonnlp.orjson = orjson
+        assert lines[0] == '{"text":"Ich bin ein Berliner.","sentences":{"0":{"tokens":[1,2]}}}'
+
+    def test_pool(self):
+        from flairjsonnlp.pool import InferencePool
+        expected = FlairPipeline.process_many([text] * 4, lang='multi')
+        with InferencePool(lang='multi', workers=2, batch_size=1) as pool:
+            actual = FlairPipeline.process_many([text] * 4, lang='multi', pool=pool)
+            with pytest.raises(ValueError):
+                FlairPipeline.process(text, lang='en', pool=pool)
+        for a, e in zip(actual, expected):
+            assert [t.get('entity') for t in a['documents'][0]['tokenList']] == [t.get('entity') for t in e['documents'][0]['tokenList']]
+
 
 class TestFlairEmbeddings(TestCase):
     def test_no_embeddings(self):
@@ -90,6 +216,35 @@ class TestFlairEmbeddings(TestCase):
         with pytest.raises(ValueError):
             FlairPipeline().process(text, lang='multi', fast=True, use_embeddings='martian', char_embeddings=False, bpe_size=0)
 
+    def test_compact_roundtrip(self):
+        expected = FlairPipeline().process(text, lang='en', use_embeddings='glove')
+        actual = inline(compact(copy.deepcopy(expected), EmbeddingFormat('base64', 'float32')))
+        for a, e in zip(actual['documents'][0]['tokenList'], expected['documents'][0]['tokenList']):
+            assert a['embeddings'][0]['vector'] == pytest.approx(e['embeddings'][0]['vector'])
+
+    def test_compact_sidecar(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fmt = EmbeddingFormat('sidecar', 'float16', dims=10, store=VectorStore(os.path.join(tmp, 'vectors.bin')))
+            actual = FlairPipeline().process(text, lang='en', use_embeddings='glove', embedding_format=fmt)
+            d = actual['documents'][0]
+            assert d['embeddings'][0]['shape'] == [len(d['tokenList']), 10]
+            assert 'vector' not in d['tokenList'][0]['embeddings'][0]
+            assert len(inline(actual)['documents'][0]['tokenList'][0]['embeddings'][0]['vector']) == 10
+
+    def test_int8_dims(self):
+        import numpy as np
+        from flairjsonnlp.vectors import unpack
+        vectors = np.array([[0.5, -1.0, 0.25], [0.0, 0.0, 0.0]], dtype=np.float32)
+        e = EmbeddingFormat('base64', 'int8', dims=2).pack(vectors, 'glove')
+        assert unpack(e) == pytest.approx(vectors[:, :2], abs=0.01)
+        assert EmbeddingFormat('base64', 'int8').pack(np.zeros((2, 0), dtype=np.float32), 'glove')['shape'] == [2, 0]
+        for dims in (0, -1, []):
+            with pytest.raises(ValueError):
+                EmbeddingFormat('base64', 'int8', dims=dims)
+        from flairjsonnlp.__main__ import main
+        with pytest.raises(SystemExit):
+            main(['--embeddings', 'glove', '--vectors', 'base64', '--vectors-dims', '0'])
+
     def test_validation_default(self):
         assert validation.is_valid(FlairPipeline.process(text, lang='en', use_embeddings='default'))
 
@@ -98,3 +253,397 @@ class TestFlairEmbeddings(TestCase):
 
     def test_validation_chars(self):
         assert validation.is_valid(FlairPipeline.process(text, lang='en', char_embeddings=True))
+
+
+class TestEmbeddingRegistry(TestCase):
+    def test_reuse(self):
+        registry = EmbeddingRegistry(max_entries=2)
+        key = EmbeddingRegistry.key(['glove', ''], False, 'en', 0)
+        assert key == EmbeddingRegistry.key(['glove'], False, 'de', 0)
+        first = registry.get(key, object)
+        assert registry.get(key, object) is first
+        assert registry.stats()['hits'] == 1 and registry.stats()['misses'] == 1
+
+    def test_eviction(self):
+        registry = EmbeddingRegistry(max_entries=2)
+        for k in 'abc':
+            registry.get(k, object)
+        assert registry.keys() == ['b', 'c']
+        assert registry.stats()['evictions'] == 1
+
+
+class TestModelRegistry(TestCase):
+    def test_single_load(self):
+        registry = ModelRegistry()
+        loads = []
+
+        def load():
+            loads.append(1)
+            time.sleep(0.05)
+            return object()
+
+        threads = [threading.Thread(target=registry.get, args=('ner', load)) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(loads) == 1
+
+    def test_pin(self):
+        registry = ModelRegistry(max_entries=2)
+        registry.get('pos', object)
+        registry.pin('pos')
+        for k in ('ner', 'frame', 'chunk'):
+            registry.get(k, object)
+        assert registry.keys() == ['pos', 'chunk']
+        assert [r['pinned'] for r in registry.resident()] == [True, False]
+
+
+class TestAnnotationCache(TestCase):
+    def test_document(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = AnnotationCache(os.path.join(tmp, 'cache.sqlite'))
+            expected = FlairPipeline.process(text, lang='en', cache=cache)
+            actual = FlairPipeline.process(text, lang='en', cache=cache, timing=True)
+            assert actual['documents'][0]['tokenList'] == expected['documents'][0]['tokenList']
+            assert actual['documents'][0]['sentences'] == expected['documents'][0]['sentences']
+            assert cache.stats()['hits'] == 1
+            assert expected['documents'][0]['meta']['models'] and actual['documents'][0]['meta']['models'] == {}
+            assert list(actual['documents'][0]['meta']['timing']) == ['cache', 'documents']
+            FlairPipeline.process(text, lang='en', fast=False, cache=cache)
+            assert cache.stats()['misses'] == 2
+
+    def test_duplicate_texts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = AnnotationCache(os.path.join(tmp, 'cache.sqlite'))
+            FlairPipeline.process(text, lang='en', cache=cache)
+            first, second = FlairPipeline.process_many([text, text], lang='en', cache=cache, timing=True)
+            assert first is not second and first == second
+            meta = second['documents'][0]['meta']
+            assert meta['models'] == {} and meta['timing']['documents'] == 2
+            first['documents'][0]['meta']['timing']['cache'] = -1.0
+            first['documents'][0]['tokenList'].clear()
+            assert meta['timing']['cache'] >= 0 and second['documents'][0]['tokenList']
+
+    def test_sentence(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = AnnotationCache(os.path.join(tmp, 'cache.sqlite'), granularity='sentence')
+            expected = FlairPipeline.process(text, lang='en')
+            FlairPipeline.process(text, lang='en', cache=cache)
+            actual = FlairPipeline.process('A new sentence. ' + text, lang='en', use_embeddings='glove', cache=cache)
+            assert cache.stats()['hits'] == 2
+            tail = actual['documents'][0]['tokenList'][-len(expected['documents'][0]['tokenList']):]
+            assert [t['upos'] for t in tail] == [t['upos'] for t in expected['documents'][0]['tokenList']]
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = AnnotationCache(os.path.join(tmp, 'cache.sqlite'), max_bytes=1000)
+            for i in range(10):
+                cache.put(str(i), 'x' * 200)
+            assert cache.size <= 1000
+            assert cache.get('0') is None and cache.get('9') == 'x' * 200
+
+    def test_json(self):
+        import pickle
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = AnnotationCache(os.path.join(tmp, 'cache.sqlite'))
+            cache.put('tags', ([{'ner': ('S-LOC', 0.5)}], [('POSITIVE', 0.9)]))
+            assert cache.get('tags') == [[{'ner': ['S-LOC', 0.5]}], [['POSITIVE', 0.9]]]
+            cache.put('document', OrderedDict([('sentences', {0: {'tokens': [1, 2]}})]))
+            assert cache.get('document') == {'sentences': {0: {'tokens': [1, 2]}}}
+            # a pickle is never loaded
+            with cache._db:
+                cache._db.execute('UPDATE annotations SET value = ? WHERE key = ?', (pickle.dumps(print), 'tags'))
+            assert cache.get('tags') is None
+
+
+class TestMicroBatcher(TestCase):
+    def test_batching(self):
+        from flairjsonnlp.async_server import MicroBatcher
+        calls = []
+
+        def process(texts, **params):
+            calls.append((list(texts), params))
+            return [t.upper() for t in texts]
+
+        async def run():
+            batcher = MicroBatcher(process, max_batch_size=8, max_wait_ms=50)
+            batcher.start()
+            results = await asyncio.gather(*(batcher.submit(t, {'lang': 'en'}) for t in 'abc'),
+                                           batcher.submit('d', {'lang': 'de'}))
+            await batcher.stop()
+            return results
+
+        assert asyncio.run(run()) == ['A', 'B', 'C', 'D']
+        assert calls == [(['a', 'b', 'c'], {'lang': 'en'}), (['d'], {'lang': 'de'})]
+
+    def test_overloaded(self):
+        from flairjsonnlp.async_server import MicroBatcher, Overloaded
+
+        async def run():
+            batcher = MicroBatcher(lambda texts: texts, max_queue=1)
+            # not started, so nothing takes requests off the queue
+            batcher._queue = asyncio.Queue(maxsize=1)
+            batcher._queue.put_nowait(None)
+            with pytest.raises(Overloaded):
+                await batcher.submit(text, {})
+
+        asyncio.run(run())
+
+    def test_warm_up_error(self):
+        from aiohttp.test_utils import TestClient, TestServer
+        from flairjsonnlp.async_server import MicroBatcher, create_app
+
+        def process(texts, **params):
+            raise OSError('no such model')
+
+        async def run():
+            client = TestClient(TestServer(create_app(MicroBatcher(process), warm_up={'lang': 'en'})))
+            await client.start_server()
+            try:
+                await client.app['warm_up']
+                response = await client.get('/ready')
+                return response.status, await response.json()
+            finally:
+                await client.close()
+
+        status, body = asyncio.run(run())
+        assert status == 503 and body == {'ready': False, 'warm_up': {'error': 'OSError: no such model'}}
+
+    def test_parse_params(self):
+        from flairjsonnlp.async_server import parse_params
+        params = parse_params({'text': text, 'fast': False, 'layers': ['ner', 'upos'], 'bpe_size': 50, 'pos': 'no'})
+        assert params['fast'] is False and params['pos'] is False and params['bpe_size'] == 50
+        assert params['layers'] == ('ner', 'upos')
+        assert parse_params({'layers': 'upos,ner', 'sentiment': '1'})['layers'] == ('ner', 'upos')
+        for query in ({'fast': 'maybe'}, {'bpe_size': 'x'}, {'bpe_size': True}, {'layers': ['martian']},
+                      {'layers': {'ner': 1}}, {'lang': ['en']}, {'color': 'red'}):
+            with pytest.raises(ValueError):
+                parse_params(query)
+
+
+class TestBenchmark(TestCase):
+    def test_stub_run(self):
+        from flairjsonnlp import benchmark, model_registry
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.json')
+            benchmark.main(['--docs', '3', '--latency-docs', '2', '--batch-sizes', '2', '--doc-sentences', '1,2',
+                            '--model-sets', 'ner,full', '-o', path])
+            with open(path) as f:
+                results = json.load(f)['results']
+        assert len(results) == 4
+        for r in results:
+            assert r['docs_per_sec'] > 0 and r['latency_p50'] <= r['latency_p99']
+            assert {'load', 'segment', 'tag', 'json', 'predict:ner-fast', 'predict:pos-multi-fast'} <= set(r['stages'])
+        assert 'predict:en-sentiment' in results[-1]['stages'] and 'predict:en-sentiment' not in results[0]['stages']
+        assert benchmark.compare(results, results, 0.1) == []
+        assert ('sequence', 'ner-fast') not in model_registry
+
+
+class TestWarmup(TestCase):
+    def test_lazy_import(self):
+        code = "import sys, flairjsonnlp; print(any(m in sys.modules for m in ('flair.models', 'flair.embeddings', 'torch')))"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, cwd=root, check=True).stdout
+        assert out.strip() == b'False'
+
+    def test_manifest_model_names(self):
+        from flairjsonnlp.warmup import manifest_model_names
+        names = manifest_model_names({'languages': ['en', 'de'], 'fast': [True, False], 'layers': ['ner', 'upos']})
+        assert ('sequence', 'ner-fast') in names and ('sequence', 'ner') in names and ('sequence', 'de-ner-germeval') in names
+        assert ('sequence', 'pos-fast') not in names and ('classifier', 'en-sentiment') not in names
+        assert len(names) == len(set(names))
+        with pytest.raises(ValueError):
+            manifest_model_names({'layers': ['parse']})
+
+    def test_model_dir(self):
+        from flairjsonnlp import model_registry, set_model_dir
+        from flairjsonnlp.benchmark import stub_model
+        from flairjsonnlp.warmup import manifest_model_names, warm_up
+        manifest = {'languages': ['fr'], 'layers': ['ner', 'upos']}
+        names = manifest_model_names(manifest)
+        with tempfile.TemporaryDirectory() as tmp:
+            for _, name in names:
+                stub_model('ner').save(os.path.join(tmp, f'{name}.pt'))
+            try:
+                report = warm_up(dict(manifest, model_dir=tmp), threads=2)
+                assert list(report['models']) == [name for _, name in names]
+                assert all(key in model_registry for key in names)
+            finally:
+                set_model_dir(None)
+                for key in names:
+                    model_registry.unload(key)
+
+
+class TestChunking(TestCase):
+    def test_token_budget(self):
+        from flairjsonnlp import get_batches
+        sentences = FlairPipeline.segment_text(text * 3)
+        for batch in get_batches(sentences, 32, max_tokens=30):
+            assert len(batch) == 1 or len(batch) * len(batch[0]) <= 30
+
+    def test_split_merge(self):
+        from flair.data import Label
+        sentence = FlairPipeline.segment_text(' '.join(f'w{i}' for i in range(100)))[0]
+        chunking = Chunking(max_length=30, overlap=10)
+        tagged, parts = chunking.split([sentence])
+        assert len(tagged) == 5 and all(len(s) <= 30 for s in tagged)
+        for s in tagged:
+            for token in s:
+                token.add_tag('ner', token.text, 1.0)
+            s.add_label(Label('POSITIVE', 0.5))
+        Chunking.merge(parts)
+        assert [t.get_tag('ner').value for t in sentence] == [t.text for t in sentence]
+        assert [label.value for label in sentence.labels] == ['POSITIVE']
+        with pytest.raises(ValueError):
+            Chunking(max_length=10, overlap=5)
+
+    def test_long_document(self):
+        long_text = ' '.join([text] * 20)
+        expected = FlairPipeline.process(long_text, lang='multi')
+        actual = FlairPipeline.process(long_text, lang='multi', chunking=Chunking(max_tokens=64, max_length=8, overlap=2, threads=2))
+        assert validation.is_valid(actual)
+        offsets = lambda j: [(t['id'], t['characterOffsetBegin'], t['characterOffsetEnd']) for t in j['documents'][0]['tokenList']]
+        assert offsets(actual) == offsets(expected)
+        assert all('upos' in t for t in actual['documents'][0]['tokenList'])
+
+
+class TestIncremental(TestCase):
+    def test_unchanged(self):
+        expected = FlairPipeline.process(text, lang='en', expressions=True)
+        actual = FlairPipeline.process_incremental(json.loads(json.dumps(expected)), text, lang='en', expressions=True)
+        assert actual['documents'][0].pop('meta')['models'] == {}
+        expected['documents'][0].pop('meta')
+        assert json.dumps(actual) == json.dumps(expected)
+
+    def test_edit(self):
+        previous = FlairPipeline.process(text, lang='multi')
+        edited = 'Berlin is a city in Germany. ' + text.replace('People are afraid', 'Drivers are afraid')
+        expected = FlairPipeline.process(edited, lang='multi')
+        actual = FlairPipeline.process_incremental(previous, edited, lang='multi')
+        assert validation.is_valid(actual)
+        strip = ('scores',)
+        assert [{k: v for k, v in t.items() if k not in strip} for t in actual['documents'][0]['tokenList']] == \
+               [{k: v for k, v in t.items() if k not in strip} for t in expected['documents'][0]['tokenList']]
+        assert actual['documents'][0]['sentences'] == expected['documents'][0]['sentences']
+
+    def test_tags_from_json(self):
+        from flairjsonnlp import expression_tags, previous_sentences, tags_from_json
+        d = {'tokenList': [{'id': 1, 'text': 'New', 'upos': 'PROPN', 'entity': 'B-LOC', 'scores': {'upos': 0.9, 'entity': 0.8},
+                            'synsets': {'new.a.01': {'wordnetId': 'new.a.01', 'scores': {'wordnetId': 0.7}}}},
+                           {'id': 2, 'text': 'York', 'entity_iob': 'O'}],
+             'sentences': {'0': {'id': '0', 'tokenFrom': 1, 'tokenTo': 3, 'labels': [{'label': 'POSITIVE', 'scores': {'label': 0.6}}]}},
+             'expressions': [{'type': 'NP', 'scores': {'type': 0.5}, 'tokens': [1, 2]}]}
+        (tokens, labels), = previous_sentences(d)
+        token_tags, sentence_labels = tags_from_json(tokens, labels, expression_tags(d))
+        assert token_tags == [{'upos': ('PROPN', 0.9), 'ner': ('B-LOC', 0.8), 'frame': ('new.01', 0.7), 'np': ('B-NP', 0.5)},
+                              {'ner': ('O', 0.0), 'np': ('E-NP', 0.5)}]
+        assert sentence_labels == [('POSITIVE', 0.6)]
+
+
+class TestLayers(TestCase):
+    def test_plan(self):
+        from flairjsonnlp import get_model_names, plan_models
+        assert plan_models({'frame'}, 'en', False, True) == [('sequence', 'frame-fast'), ('sequence', 'pos-multi-fast')]
+        assert plan_models({'frame', 'ner'}, 'de', False, True) == [('sequence', 'de-ner-germeval')]
+        assert plan_models({'upos', 'pos', 'ner', 'frame', 'sentiment'}, 'en', True, False) == get_model_names('en', True, False, False, True, True)
+        with pytest.raises(ValueError):
+            plan_models({'dependencies'}, 'en', False, True)
+
+    def test_ner_only(self):
+        actual = FlairPipeline.process(text, lang='multi', layers={'ner'})
+        assert list(actual['documents'][0]['meta']['models']) == ['ner-multi-fast']
+        assert all(t['entity_iob'] and 'upos' not in t for t in actual['documents'][0]['tokenList'])
+
+    def test_frame_needs_upos(self):
+        actual = FlairPipeline.process(text, lang='en', layers={'frame'})
+        meta = actual['documents'][0]['meta']['models']
+        assert list(meta) == ['frame-fast', 'pos-multi-fast'] and all(t >= 0 for t in meta.values())
+        tokens = actual['documents'][0]['tokenList']
+        assert any('synsets' in t for t in tokens) and not any('upos' in t or 'entity_iob' in t for t in tokens)
+
+
+class TestQuantize(TestCase):
+    def test_compare(self):
+        from flairjsonnlp.benchmark import make_corpus, stub_model
+        from flairjsonnlp.quantize import compare, quantize
+        model = stub_model('ner')
+        quantized = quantize(copy.deepcopy(model))
+        assert 'quantized' in type(quantized.rnn).__module__ and 'quantized' in type(quantized.linear).__module__
+        r = compare(model, quantized, make_corpus(4, 3), batch_size=8)
+        assert r['items'] > 0 and 0 <= r['agreement'] <= 1 and r['speedup'] > 0
+
+    def test_backend(self):
+        import flairjsonnlp
+        from flair.models import SequenceTagger
+        from flairjsonnlp.benchmark import stub_model
+        from flairjsonnlp.quantize import load_quantized, quantized_path
+        with tempfile.TemporaryDirectory() as models, tempfile.TemporaryDirectory() as cache:
+            stub_model('ner').save(os.path.join(models, 'ner-fast.pt'))
+            flairjsonnlp.set_model_dir(models)
+            try:
+                first = load_quantized(SequenceTagger, 'ner-fast', cache)
+                assert os.listdir(cache) == [os.path.basename(quantized_path('ner-fast', cache))]
+                second = load_quantized(SequenceTagger, 'ner-fast', cache)
+                sentences = FlairPipeline.segment_text(text)
+                first.predict(sentences)
+                tags = [t.get_tag('ner').value for s in sentences for t in s]
+                sentences = FlairPipeline.segment_text(text)
+                second.predict(sentences)
+                assert [t.get_tag('ner').value for s in sentences for t in s] == tags
+            finally:
+                flairjsonnlp.set_model_dir(None)
+        with pytest.raises(ValueError):
+            flairjsonnlp.set_backend('fp16')
+
+
+class TestMetrics(TestCase):
+    def test_exposition(self):
+        from flairjsonnlp.metrics import Metrics
+        m = Metrics()
+        requests = m.counter('requests_total', 'Requests', ('route',))
+        latency = m.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+        requests.inc(route='/')
+        assert m.snapshot()['requests_total'] == []
+        m.enable()
+        requests.inc(route='/')
+        requests.inc(2, route='/')
+        for v in (0.05, 0.5, 5):
+            latency.observe(v)
+        assert requests.value(route='/') == 3
+        assert latency.value()['buckets'] == OrderedDict([(0.1, 1), (1, 2), (float('inf'), 3)])
+        exposition = m.prometheus()
+        assert '# TYPE latency_seconds histogram' in exposition
+        assert 'requests_total{route="/"} 3' in exposition
+        assert 'latency_seconds_bucket{le="+Inf"} 3' in exposition and 'latency_seconds_count 3' in exposition
+        with pytest.raises(ValueError):
+            requests.inc(path='/')
+
+    def test_pipeline(self):
+        from flairjsonnlp import metrics
+        metrics.reset()
+        metrics.enable()
+        try:
+            j = FlairPipeline.process(text, fast=True, timing=True)
+            timing = j['documents'][0]['meta']['timing']
+            assert {'segment', 'tag', 'json'} <= set(timing) and timing['documents'] == 1
+            snapshot = metrics.snapshot()
+            assert snapshot['flairjsonnlp_documents_total'][0]['value'] == 1
+            assert snapshot['flairjsonnlp_sentences_total'][0]['value'] == 2
+            assert snapshot['flairjsonnlp_batch_sentences'][0]['value']['count'] > 0
+            assert {s['labels']['stage'] for s in snapshot['flairjsonnlp_stage_seconds']} >= {'segment', 'tag', 'json'}
+            assert snapshot['process_resident_memory_bytes'][0]['value'] > 0
+            assert 'flairjsonnlp_model_seconds_count{model="ner-fast"} 1' in metrics.prometheus()
+        finally:
+            metrics.enable(False)
+            metrics.reset()
+        assert 'timing' not in FlairPipeline.process(text, fast=True)['documents'][0]['meta']
+        assert metrics.snapshot()['flairjsonnlp_documents_total'] == []
+
+    def test_meta_per_document(self):
+        first, second = FlairPipeline.process_many([text, text], fast=True, timing=True)
+        first, second = first['documents'][0]['meta'], second['documents'][0]['meta']
+        assert first['models'] == second['models'] and first['timing'] == second['timing']
+        first['models'].clear()
+        first['timing']['segment'] = -1.0
+        assert second['models'] and second['timing']['segment'] >= 0